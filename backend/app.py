@@ -1,84 +1,57 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+import os
 import sqlite3
-from datetime import datetime
-import re
-import bcrypt
-import jwt
+import zipfile
+from io import BytesIO
+from itertools import zip_longest
+
+import archive
+import auth
+import changes
+import db
+from db import get_db, get_main_db
+import formats
+import httpcache
+from httpcache import conditional
+import ingest
+from listing import ListQuery, list_response
+import metrics
+import migrations
+import ranges
+import reports
+import search
+import shards
+import stats
+import trends
 
 app = Flask(__name__)
-CORS(app)
-
-SECRET_KEY = 'your_secret_key_here'
+CORS(app, expose_headers=['X-Next-Cursor', 'X-Missing-Patients'])
+db.init_app(app)
+shards.init_app(app)
+metrics.init_app(app)
+formats.init_app(app)
+app.config.setdefault('REPORT_CACHE_DIR', os.environ.get('MEDLAB_REPORT_CACHE', 'report_cache'))
+app.config.setdefault('REPORT_WORKERS', int(os.environ.get('MEDLAB_REPORT_WORKERS', '0')) or None)
 
 def init_db():
-    conn = sqlite3.connect('patients.db')
-    db_cursor = conn.cursor()
-
-    # Create patients table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            full_name TEXT NOT NULL,
-            age INTEGER NOT NULL,
-            gender TEXT NOT NULL,
-            contact_number TEXT NOT NULL,
-            email TEXT NOT NULL,
-            patient_code TEXT NOT NULL UNIQUE,
-            address TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Create tests table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER NOT NULL,
-            test_category TEXT NOT NULL,
-            test_name TEXT NOT NULL,
-            test_value REAL NOT NULL,
-            normal_range TEXT NOT NULL,
-            unit TEXT NOT NULL,
-            additional_note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
-
-    # Create labs table if not exists
-    db_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS labs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            slogan TEXT,
-            address TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            email TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    with db.get_pool(app.config['DATABASE']).connection() as conn:
+        migrations.migrate(conn)
 
-    conn.commit()
-    conn.close()
-
-def init_user_table():
-    conn = sqlite3.connect('patients.db')
-    db_cursor = conn.cursor()
-    db_cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        email TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL
-    )''')
-    conn.commit()
-    conn.close()
+        router = app.extensions['shards']
+        router.load(conn)
+    for shard_id, path in router.shards()[1:]:
+        shards.initialize(path, shard_id)
 
 # Initialize database when the app starts
 init_db()
-init_user_table()
 
-def fetch_patient_data_from_db(patient_code):
-    conn = sqlite3.connect('patients.db')
+@app.errorhandler(db.PoolTimeout)
+def pool_timeout(e):
+    # Every pooled connection is busy; clients retry instead of queueing forever
+    return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+
+def fetch_patient_data_from_db(conn, patient_code):
     cursor = conn.cursor()
 
     # Query to fetch patient details
@@ -89,8 +62,6 @@ def fetch_patient_data_from_db(patient_code):
     cursor.execute(query, (patient_code,))
     patient_data = cursor.fetchone()
 
-    conn.close()
-
     if patient_data:
         # Convert the patient data to a dictionary
         columns = [column[0] for column in cursor.description]
@@ -113,8 +84,11 @@ def fetch_patient_data_from_db(patient_code):
         return None
 
 @app.route('/api/patient-report/<patient_code>', methods=['GET'])
+@conditional('patients')
 def get_patient_report(patient_code):
-    patient_data = fetch_patient_data_from_db(patient_code)
+    # Codes are unique per shard; without a labId the first match wins
+    matches = shards.query(lambda conn: fetch_patient_data_from_db(conn, patient_code))
+    patient_data = next((match for match in matches if match), None)
 
     if patient_data:
         return jsonify(patient_data)
@@ -122,30 +96,43 @@ def get_patient_report(patient_code):
         return jsonify({"error": "Patient not found"}), 404
 
 # Existing routes
+PATIENT_LIST = ListQuery(
+    {
+        'id': 'id',
+        'fullName': 'full_name',
+        'age': 'age',
+        'gender': 'gender',
+        'contactNumber': 'contact_number',
+        'email': 'email',
+        'patientCode': 'patient_code',
+        'address': 'address',
+        'createdAt': 'created_at',
+        'labId': 'lab_id',
+    },
+    'patients',
+    created_col='created_at',
+    id_col='id',
+    filters={'labId': 'lab_id'},
+)
+
 @app.route('/api/patients', methods=['GET'])
+@conditional('patients')
 def get_patients():
-    conn = sqlite3.connect('patients.db')
-    db_cursor = conn.cursor()
-
-    db_cursor.execute('SELECT * FROM patients ORDER BY created_at DESC')
-    patients = db_cursor.fetchall()
-    conn.close()
-
-    patient_list = []
-    for patient in patients:
-        patient_list.append({
-            'id': patient[0],
-            'fullName': patient[1],
-            'age': patient[2],
-            'gender': patient[3],
-            'contactNumber': patient[4],
-            'email': patient[5],
-            'patientCode': patient[6],
-            'address': patient[7],
-            'createdAt': patient[8]
-        })
-
-    return jsonify(patient_list)
+    return list_response(PATIENT_LIST)
+
+@app.route('/api/patients/search', methods=['GET'])
+@conditional('patients')
+def search_patients():
+    limit = request.args.get('limit', search.DEFAULT_LIMIT, type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    text, lab_id = request.args.get('q', ''), shards.lab_id()
+    results = shards.query(lambda conn: search.search_patients(conn, text, limit, lab_id))
+    if len(results) == 1:
+        return jsonify(results[0])
+    # Interleave each shard's ranked matches
+    merged = [row for ranked in zip_longest(*results) for row in ranked if row is not None]
+    return jsonify(merged[:limit])
 
 @app.route('/api/patients', methods=['POST'])
 def add_patient():
@@ -157,12 +144,12 @@ def add_patient():
             return jsonify({'error': f'Missing required field: {field}'}), 400
 
     try:
-        conn = sqlite3.connect('patients.db')
+        conn = get_db()
         db_cursor = conn.cursor()
 
         db_cursor.execute('''
-            INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address, lab_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             data['fullName'],
             data['age'],
@@ -170,47 +157,60 @@ def add_patient():
             data['contactNumber'],
             data['email'],
             data['patientCode'],
-            data['address']
+            data['address'],
+            shards.lab_id()
         ))
         conn.commit()
-        conn.close()
+        httpcache.invalidate('patients')
+        changes.notify()
         return jsonify({'message': 'Patient added successfully'}), 201
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Patient code already exists'}), 400
+    except db.PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+TEST_LIST = ListQuery(
+    {
+        'id': 't.id',
+        'patientId': 't.patient_id',
+        'patientName': 'p.full_name',
+        'patientCode': 'p.patient_code',
+        'testCategory': 't.test_category',
+        'testName': 't.test_name',
+        'testValue': 't.test_value',
+        'normalRange': 't.normal_range',
+        'unit': 't.unit',
+        'additionalNote': 't.additional_note',
+        'createdAt': 't.created_at',
+        'status': 't.status',
+        'labId': 't.lab_id',
+    },
+    'tests t JOIN patients p ON t.patient_id = p.id',
+    created_col='t.created_at',
+    id_col='t.id',
+    filters={'status': 't.status', 'patientId': 't.patient_id', 'labId': 't.lab_id'},
+)
+
+@app.route('/api/patients/batch', methods=['POST'])
+def add_patients_batch():
+    try:
+        summary = ingest.ingest_patients(get_db(), shards.lab_id())
+        httpcache.invalidate('patients')
+        changes.notify()
+    except ingest.RowError as e:
+        return jsonify({'error': str(e)}), 400
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    return jsonify(summary), 201 if summary['inserted'] else 400
 
 @app.route('/api/tests', methods=['GET'])
+@conditional('tests', 'patients')
 def get_tests():
-    conn = sqlite3.connect('patients.db')
-    db_cursor = conn.cursor()
-
-    db_cursor.execute('''
-        SELECT t.*, p.full_name, p.patient_code
-        FROM tests t
-        JOIN patients p ON t.patient_id = p.id
-        ORDER BY t.created_at DESC
-    ''')
-    tests = db_cursor.fetchall()
-    conn.close()
-
-    test_list = []
-    for test in tests:
-        test_list.append({
-            'id': test[0],
-            'patientId': test[1],
-            'patientName': test[9] if len(test) > 9 else "",
-            'patientCode': test[10] if len(test) > 10 else "",
-            'testCategory': test[2],
-            'testName': test[3],
-            'testValue': test[4],
-            'normalRange': test[5],
-            'unit': test[6],
-            'additionalNote': test[7],
-            'createdAt': test[8]
-        })
-
-    return jsonify(test_list)
+    return list_response(TEST_LIST)
 
 @app.route('/api/tests', methods=['POST'])
 def add_test():
@@ -222,12 +222,19 @@ def add_test():
             return jsonify({'error': f'Missing required field: {field}'}), 400
 
     try:
-        conn = sqlite3.connect('patients.db')
+        # The patient's id says which shard it lives in
+        shards.route_by_id(data['patientId'])
+        conn = get_db()
         db_cursor = conn.cursor()
 
+        db_cursor.execute('SELECT gender, age FROM patients WHERE id = ?', (data['patientId'],))
+        patient = db_cursor.fetchone() or (None, None)
+        status = ranges.classify(data['normalRange'], data['testValue'], *patient)
+
         db_cursor.execute('''
-            INSERT INTO tests (patient_id, test_category, test_name, test_value, normal_range, unit, additional_note)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO tests (patient_id, test_category, test_name, test_value, normal_range, unit, additional_note, status,
+                               lab_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT lab_id FROM patients WHERE id = ?1))
         ''', (
             data['patientId'],
             data['testCategory'],
@@ -235,33 +242,78 @@ def add_test():
             data['testValue'],
             data['normalRange'],
             data['unit'],
-            data.get('additionalNote', '')
+            data.get('additionalNote', ''),
+            status
         ))
         conn.commit()
-        conn.close()
+        httpcache.invalidate('tests')
+        changes.notify()
         return jsonify({'message': 'Test result added successfully'}), 201
+    except db.PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/tests/batch', methods=['POST'])
+def add_tests_batch():
+    try:
+        summary = ingest.ingest_tests(db.connection_for, shards.group_ids)
+        httpcache.invalidate('tests')
+        changes.notify()
+    except ingest.RowError as e:
+        return jsonify({'error': str(e)}), 400
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    return jsonify(summary), 201 if summary['inserted'] else 400
 
 @app.route('/api/tests/<int:test_id>', methods=['DELETE'])
 def delete_test(test_id):
     try:
-        conn = sqlite3.connect('patients.db')
+        conn = get_db()
         db_cursor = conn.cursor()
         db_cursor.execute('DELETE FROM tests WHERE id = ?', (test_id,))
         conn.commit()
-        conn.close()
+        if db_cursor.rowcount == 0 and archive.is_archived(conn, test_id):
+            return jsonify({'error': 'Archived tests cannot be deleted'}), 409
+        httpcache.invalidate('tests')
+        changes.notify()
         return jsonify({'message': 'Test deleted successfully'})
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Fields sent with lab change events, named as in get_labs
+LAB_FIELDS = ListQuery(
+    {
+        'id': 'id',
+        'name': 'name',
+        'slogan': 'slogan',
+        'address': 'address',
+        'phone': 'phone',
+        'email': 'email',
+        'createdAt': 'created_at',
+    },
+    'labs',
+    created_col='created_at',
+    id_col='id',
+)
+
+changes.init_app(app, {'patients': PATIENT_LIST, 'tests': TEST_LIST, 'labs': LAB_FIELDS})
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    return changes.changes_response()
+
 @app.route('/api/labs', methods=['GET'])
+@conditional('labs')
 def get_labs():
-    conn = sqlite3.connect('patients.db')
+    conn = get_main_db()
     db_cursor = conn.cursor()
     db_cursor.execute('SELECT * FROM labs ORDER BY created_at DESC')
     labs = db_cursor.fetchall()
-    conn.close()
     lab_list = []
     for lab in labs:
         lab_list.append({
@@ -283,7 +335,7 @@ def add_lab():
         if field not in data:
             return jsonify({'error': f'Missing required field: {field}'}), 400
     try:
-        conn = sqlite3.connect('patients.db')
+        conn = get_main_db()
         db_cursor = conn.cursor()
         db_cursor.execute('''
             INSERT INTO labs (name, slogan, address, phone, email)
@@ -295,16 +347,33 @@ def add_lab():
             data['phone'],
             data['email']
         ))
+        if shards.SHARD_DIR:
+            router = shards.router()
+            path = os.path.join(shards.SHARD_DIR, f'lab-{db_cursor.lastrowid}.db')
+            router.assign(conn, db_cursor.lastrowid, router.create_shard(conn, path))
         conn.commit()
-        conn.close()
+        httpcache.invalidate('labs')
+        changes.notify()
         return jsonify({'message': 'Lab added successfully'}), 201
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+REPORT_TEST_COLUMNS = (
+    'id', 'patient_id', 'test_category', 'test_name', 'test_value', 'normal_range', 'unit',
+    'additional_note', 'created_at', 'status',
+)
+
 @app.route('/api/reports/<int:patient_id>', methods=['GET'])
+@conditional('patients', 'tests')
 def generate_report(patient_id):
     try:
-        conn = sqlite3.connect('patients.db')
+        fmt = formats.requested_format()
+    except formats.FormatError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        conn = get_db()
         db_cursor = conn.cursor()
 
         db_cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
@@ -313,54 +382,22 @@ def generate_report(patient_id):
         if not patient:
             return jsonify({'error': 'Patient not found'}), 404
 
-        db_cursor.execute('''
-            SELECT * FROM tests
-            WHERE patient_id = ?
-            ORDER BY created_at DESC
-        ''', (patient_id,))
-        tests = db_cursor.fetchall()
-
-        conn.close()
+        tests = archive.patient_tests(conn, patient_id, REPORT_TEST_COLUMNS)
 
         test_list = []
         for test in tests:
-            value = test[4]
-            ref_range = str(test[5])
-            status = 'Normal'
-            ref = ref_range.replace('–', '-').replace(' ', '')
-            match = re.match(r'^(\d+(?:\.\d+)?)-(\d+(?:\.\d+)?)$', ref)
-            if match:
-                low, high = float(match.group(1)), float(match.group(2))
-                if value < low:
-                    status = 'Low'
-                elif value > high:
-                    status = 'High'
-            elif ref.startswith('<'):
-                try:
-                    high = float(ref[1:])
-                    if value >= high:
-                        status = 'High'
-                except:
-                    pass
-            elif ref.lower().startswith('upto') or ref.lower().startswith('up to'):
-                try:
-                    high = float(re.findall(r'\d+(?:\.\d+)?', ref)[0])
-                    if value > high:
-                        status = 'High'
-                except:
-                    pass
-
             test_list.append({
                 'id': test[0],
                 'testCategory': test[2],
                 'testName': test[3],
-                'testValue': value,
+                'testValue': test[4],
                 'normalRange': test[5],
                 'unit': test[6],
                 'additionalNote': test[7],
                 'createdAt': test[8],
-                'status': status
+                'status': test[9]
             })
+        trends.annotate_deltas(test_list)
 
         report = {
             'patientName': patient[1],
@@ -370,9 +407,108 @@ def generate_report(patient_id):
             'tests': test_list
         }
 
-        return jsonify(report)
+        if fmt == 'columnar':
+            report['tests'] = formats.record_columns(test_list)
+            return formats.json_response(report, mimetype=formats.COLUMNAR)
+        return formats.json_response(report)
+    except db.PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/patients/<int:patient_id>/trends', methods=['GET'])
+@conditional('patients', 'tests')
+def get_patient_trends(patient_id):
+    test_name = request.args.get('test')
+    try:
+        conn = get_db()
+        if conn.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,)).fetchone() is None:
+            return jsonify({'error': 'Patient not found'}), 404
+        if not test_name:
+            return jsonify({'patientId': patient_id, 'tests': trends.summary(conn, patient_id)})
+        result = trends.history(
+            conn, patient_id, test_name,
+            start=request.args.get('from'),
+            end=request.args.get('to'),
+            points=request.args.get('points', type=int),
+        )
+        result['patientId'] = patient_id
+        return jsonify(result)
+    except trends.TrendQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except db.PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+_report_cache = None
+
+def report_cache():
+    global _report_cache
+    if _report_cache is None:
+        _report_cache = reports.ReportCache(app.config['REPORT_CACHE_DIR'])
+    return _report_cache
+
+@app.route('/api/reports/<int:patient_id>/pdf', methods=['GET'])
+def get_report_pdf(patient_id):
+    lab_id = request.args.get('labId', type=int)
+    try:
+        lab = reports.load_lab(get_main_db(), lab_id)
+        result = reports.get_pdf(get_db(), report_cache(), patient_id, lab)
+    except db.PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    if result is None:
+        return jsonify({'error': 'Patient not found'}), 404
+
+    key, body = result
+    response = Response(body, mimetype='application/pdf')
+    response.headers['Content-Disposition'] = f'inline; filename="report-{patient_id}.pdf"'
+    response.set_etag(key)
+    return response.make_conditional(request)
+
+@app.route('/api/reports/pdf/batch', methods=['POST'])
+def get_report_pdf_batch():
+    data = request.json or {}
+    patient_ids = data.get('patientIds')
+    if not isinstance(patient_ids, list) or not patient_ids:
+        return jsonify({'error': 'Missing required field: patientIds'}), 400
+    try:
+        rendered = {}
+        groups = shards.group_ids(patient_ids)
+        lab = reports.load_lab(get_main_db(), data.get('labId'))
+        for path, ids in groups.items():
+            with db.connection_for(path) as conn:
+                rendered.update(reports.render_batch(conn, report_cache(), ids, lab, app.config['REPORT_WORKERS']))
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    if not rendered:
+        return jsonify({'error': 'No matching patients found'}), 404
+
+    # PDF streams are already compressed, so store them as-is
+    zip_buffer = BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zf:
+        for patient_id, body in rendered.items():
+            zf.writestr(f'report-{patient_id}.pdf', body)
+    response = Response(zip_buffer.getvalue(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename="reports.zip"'
+    missing = [pid for pid in patient_ids if pid not in rendered]
+    if missing:
+        response.headers['X-Missing-Patients'] = ','.join(str(pid) for pid in missing)
+    return response
+
+@app.route('/api/stats', methods=['GET'])
+@conditional('patients', 'tests', daily=True)
+def get_stats():
+    return jsonify(stats.combine(shards.query(stats.summary)))
+
+@app.route('/api/stats/analytics', methods=['GET'])
+@conditional('patients', 'tests', daily=True)
+def get_analytics():
+    return jsonify(stats.combine(shards.query(stats.analytics)))
 
 @app.route('/api/signup', methods=['POST'])
 def signup():
@@ -381,16 +517,19 @@ def signup():
     password = data.get('password')
     if not email or not password or len(password) < 6:
         return jsonify({'error': 'Invalid email or password'}), 400
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
     try:
-        conn = sqlite3.connect('patients.db')
+        hashed = auth.hash_password(password)
+        conn = get_main_db()
         db_cursor = conn.cursor()
         db_cursor.execute('INSERT INTO users (email, password) VALUES (?, ?)', (email, hashed))
         conn.commit()
-        conn.close()
         return jsonify({'message': 'User registered successfully'})
+    except auth.AuthBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Email already exists'}), 409
+    except db.PoolTimeout:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -401,36 +540,33 @@ def signin():
     password = data.get('password')
     if not email or not password:
         return jsonify({'error': 'Missing email or password'}), 400
-    conn = sqlite3.connect('patients.db')
+    conn = get_main_db()
     db_cursor = conn.cursor()
     db_cursor.execute('SELECT id, password FROM users WHERE email = ?', (email,))
     user = db_cursor.fetchone()
-    if user:
-        if bcrypt.checkpw(password.encode('utf-8'), user[1]):
-            payload = {
-                'user_id': user[0],
-                'email': email,
-                'exp': datetime.utcnow() + datetime.timedelta(days=1)
-            }
-            token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
-            conn.close()
-            return jsonify({'token': token, 'email': email})
-        else:
-            conn.close()
+    try:
+        # Accounts are created through /api/signup only
+        if not user:
+            auth.check_unknown_user(password)
             return jsonify({'error': 'Invalid credentials'}), 401
-    else:
-        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        db_cursor.execute('INSERT INTO users (email, password) VALUES (?, ?)', (email, hashed))
-        user_id = db_cursor.lastrowid
-        conn.commit()
-        conn.close()
-        payload = {
-            'user_id': user_id,
-            'email': email,
-            'exp': datetime.utcnow() + datetime.timedelta(days=1)
-        }
-        token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
-        return jsonify({'token': token, 'email': email})
+        if not auth.check_password(password, user[1]):
+            return jsonify({'error': 'Invalid credentials'}), 401
+    except auth.AuthBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+    token = auth.issue_token(user[0], email)
+    return jsonify({'token': token, 'email': email})
+
+@app.route('/api/me', methods=['GET'])
+@auth.require_auth
+def get_current_user():
+    return jsonify({'userId': g.user['user_id'], 'email': g.user['email']})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics.render()
 
 if __name__ == '__main__':
+    # The reloader runs this module twice; only its child serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        changes.serve_streams(app)
     app.run(debug=True, port=5000)
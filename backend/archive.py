@@ -0,0 +1,288 @@
+"""Move old test results out of the live database into yearly archives.
+
+Run from the backend directory, e.g. nightly from cron::
+
+    python archive.py --older-than-days 730
+
+Each archive is a SQLite file holding one calendar year of tests, with the
+same columns and patient indexes as the live table. The live database keeps
+a manifest of which archives hold tests for each patient, so reports and
+trends only open an archive for patients that actually have results there.
+Every shard is archived in turn; shard n's archives are named
+``shard-n-tests-<year>.db`` so shards can share one archive directory.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import changes
+import db
+import migrations
+from ranges import ABNORMAL_STATUSES
+from shards import MAIN_SHARD, ShardRouter
+
+DEFAULT_ARCHIVE_DIR = os.environ.get('MEDLAB_ARCHIVE_DIR', 'archive')
+DEFAULT_OLDER_THAN_DAYS = int(os.environ.get('MEDLAB_ARCHIVE_AFTER_DAYS', '730'))
+
+# Each batch holds the live write lock for one short transaction, and the
+# pause between batches lets application writers in.
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PAUSE = 0.05
+
+# SQLite allows 10 attached databases by default
+MAX_ATTACHED = 8
+
+_ABNORMAL = ', '.join(f"'{status}'" for status in ABNORMAL_STATUSES)
+
+BATCH_SQL = '''
+    SELECT id, strftime('%Y', created_at) FROM tests
+    WHERE created_at < ?
+    ORDER BY created_at
+    LIMIT ?
+'''
+
+
+def tests_sql(columns, by_name=False, dated=False):
+    """Select one patient's tests (optionally one test, optionally only dated ones), newest first."""
+    where = 'patient_id = ? AND test_name = ?' if by_name else 'patient_id = ?'
+    if dated:
+        where += ' AND created_at IS NOT NULL'
+    return f'SELECT {", ".join(columns)} FROM tests WHERE {where} ORDER BY created_at DESC'
+
+
+def _archive_columns(archive_conn):
+    return {row[1] for row in archive_conn.execute('PRAGMA table_info(tests)')}
+
+
+def each_archive(conn, patient_id=None):
+    """Yield a pooled connection to each archive, or to each one holding tests for ``patient_id``."""
+    if patient_id is None:
+        paths = conn.execute('SELECT path FROM archives ORDER BY period DESC').fetchall()
+    else:
+        paths = conn.execute('''
+            SELECT a.path FROM archive_manifest m
+            JOIN archives a ON a.period = m.period
+            WHERE m.patient_id = ?
+            ORDER BY m.period DESC
+        ''', (patient_id,)).fetchall()
+    for (path,) in paths:
+        with db.get_pool(path).connection() as archive_conn:
+            yield archive_conn
+
+
+def archived_tests(conn, patient_id, columns, test_name=None, dated=False):
+    """Return a patient's archived tests as rows of ``columns``, newest first.
+
+    Columns added to the live table after an archive was written read as
+    NULL. With ``dated``, tests without a created_at are left out.
+    """
+    rows = []
+    for archive_conn in each_archive(conn, patient_id):
+        present = _archive_columns(archive_conn)
+        selected = [column if column in present else f'NULL AS {column}' for column in columns]
+        params = (patient_id, test_name) if test_name else (patient_id,)
+        rows.extend(archive_conn.execute(tests_sql(selected, bool(test_name), dated), params).fetchall())
+    created_at, test_id = columns.index('created_at'), columns.index('id')
+    rows.sort(key=lambda row: (row[created_at] or '', row[test_id]), reverse=True)
+    return rows
+
+
+def patient_tests(conn, patient_id, columns, test_name=None):
+    """Return a patient's live and archived tests, newest first.
+
+    ``columns`` must include id and created_at. A test copied to an archive
+    by an interrupted run can briefly exist in both; the live row wins.
+    """
+    params = (patient_id, test_name) if test_name else (patient_id,)
+    rows = conn.execute(tests_sql(columns, bool(test_name)), params).fetchall()
+    archived = archived_tests(conn, patient_id, columns, test_name)
+    if not archived:
+        return rows
+    test_id, created_at = columns.index('id'), columns.index('created_at')
+    live = {row[test_id] for row in rows}
+    rows.extend(row for row in archived if row[test_id] not in live)
+    rows.sort(key=lambda row: (row[created_at] or '', row[test_id]), reverse=True)
+    return rows
+
+
+def is_archived(conn, test_id):
+    for archive_conn in each_archive(conn):
+        if archive_conn.execute('SELECT 1 FROM tests WHERE id = ?', (test_id,)).fetchone():
+            return True
+    return False
+
+
+class Archiver:
+    """Copies batches of old tests into yearly archives, then deletes them live.
+
+    Each batch is committed to its archive before the live rows are
+    deleted, so a crash can leave a batch in both places but never in
+    neither; the next run copies it again with INSERT OR REPLACE.
+    """
+
+    def __init__(self, conn, archive_dir=DEFAULT_ARCHIVE_DIR, batch_size=DEFAULT_BATCH_SIZE, prefix=''):
+        self.conn = conn
+        self.archive_dir = os.path.abspath(archive_dir)
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self._attached = []
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+    def _path(self, period):
+        return os.path.join(self.archive_dir, f'{self.prefix}tests-{period}.db')
+
+    def _columns(self):
+        return [(row[1], row[2]) for row in self.conn.execute('PRAGMA main.table_info(tests)')]
+
+    def _attach(self, period):
+        schema = f'archive_{period}'
+        if schema in self._attached:
+            return schema
+        if len(self._attached) >= MAX_ATTACHED:
+            self.conn.execute(f'DETACH DATABASE {self._attached.pop(0)}')
+        path = self._path(period)
+        self.conn.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+        self.conn.execute(f'PRAGMA {schema}.journal_mode = WAL')
+        self._attached.append(schema)
+        self._sync_schema(schema)
+        return schema
+
+    def _sync_schema(self, schema):
+        existing = {row[1] for row in self.conn.execute(f'PRAGMA {schema}.table_info(tests)')}
+        columns = self._columns()
+        if not existing:
+            definitions = ', '.join(
+                'id INTEGER PRIMARY KEY' if name == 'id' else f'{name} {declared}' for name, declared in columns
+            )
+            self.conn.execute(f'CREATE TABLE {schema}.tests ({definitions})')
+            self.conn.execute(f'CREATE INDEX {schema}.idx_tests_patient_created ON tests (patient_id, created_at)')
+            self.conn.execute(
+                f'CREATE INDEX {schema}.idx_tests_patient_name_created ON tests (patient_id, test_name, created_at)'
+            )
+        for name, declared in columns:
+            if existing and name not in existing:
+                self.conn.execute(f'ALTER TABLE {schema}.tests ADD COLUMN {name} {declared}')
+        self.conn.commit()
+
+    def archive_batch(self, cutoff):
+        """Archive up to batch_size tests created before ``cutoff``; return the count."""
+        batch = self.conn.execute(BATCH_SQL, (cutoff, self.batch_size)).fetchall()
+        if not batch:
+            return 0
+        periods = {}
+        for test_id, period in batch:
+            periods.setdefault(period, []).append(test_id)
+
+        names = ', '.join(name for name, _ in self._columns())
+        for period, ids in periods.items():
+            schema = self._attach(period)
+            placeholders = ', '.join('?' * len(ids))
+            self.conn.execute(
+                f'INSERT OR REPLACE INTO {schema}.tests ({names}) '
+                f'SELECT {names} FROM main.tests WHERE id IN ({placeholders})',
+                ids,
+            )
+            self.conn.commit()
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Stats triggers skip these deletes: archived tests still count
+            self.conn.execute("UPDATE archive_state SET value = 1 WHERE name = 'moving'")
+            for period, ids in periods.items():
+                self._record(period, ids)
+            placeholders = ', '.join('?' * len(batch))
+            self.conn.execute(f'DELETE FROM main.tests WHERE id IN ({placeholders})', [row[0] for row in batch])
+            self.conn.execute("UPDATE archive_state SET value = 0 WHERE name = 'moving'")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(batch)
+
+    def _record(self, period, ids):
+        placeholders = ', '.join('?' * len(ids))
+        path = self._path(period)
+        self.conn.execute(f'''
+            INSERT INTO archives (period, path, tests, oldest, newest)
+            SELECT ?, ?, COUNT(*), MIN(created_at), MAX(created_at)
+            FROM main.tests WHERE id IN ({placeholders})
+            ON CONFLICT (period) DO UPDATE SET
+                path = excluded.path,
+                tests = tests + excluded.tests,
+                oldest = MIN(oldest, excluded.oldest),
+                newest = MAX(newest, excluded.newest)
+        ''', [period, path, *ids])
+        self.conn.execute(f'''
+            INSERT INTO archive_manifest (patient_id, period, tests, abnormal)
+            SELECT patient_id, ?, COUNT(*), SUM(COALESCE(status IN ({_ABNORMAL}), 0))
+            FROM main.tests WHERE id IN ({placeholders})
+            GROUP BY patient_id
+            ON CONFLICT (patient_id, period) DO UPDATE SET
+                tests = tests + excluded.tests,
+                abnormal = abnormal + excluded.abnormal
+        ''', [period, *ids])
+
+    def run(self, cutoff, pause=DEFAULT_PAUSE, max_batches=None, log=print):
+        archived = batches = 0
+        started = time.perf_counter()
+        while max_batches is None or batches < max_batches:
+            moved = self.archive_batch(cutoff)
+            if not moved:
+                break
+            archived += moved
+            batches += 1
+            if batches % 100 == 0:
+                log(f'  archived {archived} tests')
+            time.sleep(pause)
+        for schema in self._attached:
+            self.conn.execute(f'DETACH DATABASE {schema}')
+        self._attached = []
+        log(f'archived {archived} tests created before {cutoff} in {time.perf_counter() - started:.1f}s')
+        return archived
+
+
+def cutoff_for(days, now=None):
+    now = now or datetime.utcnow()
+    return (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move old test results into yearly archive databases.')
+    parser.add_argument('--db', default=db.DEFAULT_DATABASE)
+    parser.add_argument('--archive-dir', default=DEFAULT_ARCHIVE_DIR)
+    parser.add_argument('--older-than-days', type=int, default=DEFAULT_OLDER_THAN_DAYS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE, help='seconds to sleep between batches')
+    parser.add_argument('--max-batches', type=int, help='stop after this many batches')
+    parser.add_argument('--keep-changes-days', type=int, default=changes.RETENTION_DAYS,
+                        help='also drop change log entries older than this')
+    args = parser.parse_args()
+
+    conn = db.connect(args.db)
+    try:
+        migrations.migrate(conn)
+        shard_router = ShardRouter(args.db)
+        shard_router.load(conn)
+    finally:
+        conn.close()
+
+    cutoff = cutoff_for(args.older_than_days)
+    for shard, path in shard_router.shards():
+        # The main database keeps its unprefixed archive names
+        prefix = '' if shard == MAIN_SHARD else f'shard-{shard}-'
+        print(f'shard {shard} ({path})')
+        conn = db.connect(path)
+        try:
+            migrations.migrate(conn)
+            archiver = Archiver(conn, args.archive_dir, args.batch_size, prefix)
+            archiver.run(cutoff, args.pause, args.max_batches)
+            print(f'pruned {changes.prune(conn, args.keep_changes_days)} change log entries')
+        finally:
+            conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
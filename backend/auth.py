@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+import bcrypt
+import jwt
+from flask import g, jsonify, request
+
+SECRET_KEY = os.environ.get('MEDLAB_SECRET_KEY', 'your_secret_key_here')
+TOKEN_LIFETIME = timedelta(days=1)
+
+BCRYPT_ROUNDS = int(os.environ.get('MEDLAB_BCRYPT_ROUNDS', '12'))
+BCRYPT_WORKERS = int(os.environ.get('MEDLAB_BCRYPT_WORKERS', '0')) or os.cpu_count() or 2
+BCRYPT_MAX_PENDING = int(os.environ.get('MEDLAB_BCRYPT_MAX_PENDING', '32'))
+BCRYPT_TIMEOUT = float(os.environ.get('MEDLAB_BCRYPT_TIMEOUT', '10'))
+
+TOKEN_CACHE_SIZE = int(os.environ.get('MEDLAB_TOKEN_CACHE_SIZE', '1024'))
+TOKEN_CACHE_TTL = float(os.environ.get('MEDLAB_TOKEN_CACHE_TTL', '300'))
+
+
+class AuthBusy(RuntimeError):
+    pass
+
+
+class HashExecutor:
+    """Runs bcrypt on a small dedicated pool with a bounded backlog.
+
+    bcrypt releases the GIL, so the pool caps how many cores password
+    hashing may take at once. When a login burst fills the backlog, callers
+    get AuthBusy immediately instead of queueing behind each other and tying
+    up every request worker.
+    """
+
+    def __init__(self, workers=BCRYPT_WORKERS, max_pending=BCRYPT_MAX_PENDING):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def run(self, fn, *args, timeout=BCRYPT_TIMEOUT):
+        if not self._slots.acquire(blocking=False):
+            raise AuthBusy('Authentication service is busy, please retry')
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            raise AuthBusy('Authentication service is busy, please retry')
+
+
+hash_executor = HashExecutor()
+
+
+def _hash(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+def _check(password, hashed):
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+
+
+def hash_password(password):
+    return hash_executor.run(_hash, password)
+
+
+def check_password(password, hashed):
+    return hash_executor.run(_check, password, hashed)
+
+
+_dummy_hash = None
+
+
+def check_unknown_user(password):
+    """Spend one bcrypt check on a sign-in for an unknown email.
+
+    Without it a failed sign-in answers faster when the email is not
+    registered, which tells callers which emails have accounts.
+    """
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password('unknown-user')
+    check_password(password, _dummy_hash)
+
+
+def issue_token(user_id, email):
+    payload = {
+        'user_id': user_id,
+        'email': email,
+        'exp': datetime.now(timezone.utc) + TOKEN_LIFETIME,
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+
+
+class TokenCache:
+    """LRU of decoded token claims, each entry expiring after a TTL.
+
+    Entries never outlive the token's own ``exp`` claim.
+    """
+
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return claims
+
+    def put(self, token, claims):
+        expires_at = min(time.time() + self.ttl, claims.get('exp', float('inf')))
+        with self._lock:
+            self._entries[token] = (claims, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+def verify_token(token):
+    """Return the token's claims, verifying the signature only on a cache miss."""
+    claims = token_cache.get(token)
+    if claims is None:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        token_cache.put(token, claims)
+    return claims
+
+
+def require_auth(view):
+    """Reject requests without a valid ``Authorization: Bearer`` token.
+
+    The decoded claims are available to the view as ``g.user``.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        scheme, _, token = header.partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            return jsonify({'error': 'Missing bearer token'}), 401
+        try:
+            g.user = verify_token(token)
+        except jwt.ExpiredSignatureError:
+            return jsonify({'error': 'Token expired'}), 401
+        except jwt.InvalidTokenError:
+            return jsonify({'error': 'Invalid token'}), 401
+        return view(*args, **kwargs)
+    return wrapper
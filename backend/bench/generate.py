@@ -0,0 +1,187 @@
+"""Generate a synthetic lab database for benchmarking.
+
+Run from the backend directory, for example::
+
+    python -m bench.generate --db /tmp/bench.db --patients 100000 --tests 1000000
+
+The schema comes from the app's own migrations, and test names, units and
+reference ranges come from src/data/testsData.js, so generated data matches
+what the frontend would submit. This includes sex- and age-specific and
+multi-component ranges. Output is deterministic for a given --seed.
+"""
+import argparse
+import os
+import random
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import migrations
+import ranges
+
+CATALOG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'src', 'data', 'testsData.js')
+CHUNK_SIZE = 10000
+
+FIRST_NAMES = [
+    'Aarav', 'Aisha', 'Ana', 'Chen', 'David', 'Elena', 'Fatima', 'Hiroshi', 'Ibrahim', 'Jane',
+    'John', 'José', 'Kavya', 'Li', 'Maria', 'Mohammed', 'Olga', 'Priya', 'Rahul', 'Sara',
+]
+LAST_NAMES = [
+    'Ahmed', 'Chen', 'Das', 'Doe', 'Garcia', 'Gupta', 'Ivanova', 'Khan', 'Kim', 'Lopez',
+    'Müller', 'Nguyen', 'Patel', 'Rossi', 'Sato', 'Sharma', 'Silva', 'Singh', 'Smith', 'Wang',
+]
+GENDERS = ['male', 'female']
+
+_CATALOG_RE = re.compile(
+    r"\{\s*category:\s*'(?P<category>[^']*)',\s*name:\s*'(?P<name>[^']*)',\s*"
+    r"unit:\s*'(?P<unit>[^']*)',\s*referenceRange:\s*'(?P<range>[^']*)'\s*\}"
+)
+
+
+def load_catalog(path=CATALOG_PATH):
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    catalog = [m.groupdict() for m in _CATALOG_RE.finditer(source)]
+    if not catalog:
+        raise ValueError(f'No tests found in {path}')
+    return catalog
+
+
+def _interval_value(rule, rng):
+    if rule.low is not None and rule.high is not None:
+        # Centred on the range with a spread that puts ~15% of results outside it
+        mid = (rule.low + rule.high) / 2
+        return round(max(0.0, rng.gauss(mid, (rule.high - rule.low) / 2.8)), 2)
+    if rule.high is not None:
+        return round(rng.uniform(0, rule.high * 1.3), 2)
+    return round(rng.uniform(rule.low * 0.8, rule.low * 2), 2)
+
+
+def synth_value(rule, rng, gender, age):
+    if isinstance(rule, ranges.Interval):
+        if rule.qualitative and rng.random() < 0.5:
+            return 'Positive' if rng.random() < 0.05 else 'Negative'
+        return _interval_value(rule, rng)
+    if isinstance(rule, ranges.BySex):
+        key = ranges.SEX_LABELS.get(gender, 'M')
+        return synth_value(rule.rules.get(key) or next(iter(rule.rules.values())), rng, gender, age)
+    if isinstance(rule, ranges.ByAge):
+        for (low, high), band in rule.bands:
+            if age >= low and (high is None or age <= high):
+                return synth_value(band, rng, gender, age)
+        return synth_value(rule.bands[0][1], rng, gender, age)
+    if isinstance(rule, ranges.MultiComponent):
+        return '; '.join(
+            f'{name.title()}: {synth_value(component, rng, gender, age)}'
+            for name, component in rule.components.items()
+        )
+    if isinstance(rule, ranges.Qualitative):
+        if rule.expected == 'Normal':
+            return 'Abnormal' if rng.random() < 0.1 else 'Normal'
+        return 'Positive' if rng.random() < 0.05 else 'Negative'
+    return round(rng.uniform(50, 250), 1)
+
+
+def _timestamp(now, rng, days):
+    moment = now - timedelta(seconds=rng.randrange(days * 86400))
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generate(db_path, patients, tests, labs=3, days=730, seed=42, log=print):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    catalog = load_catalog()
+    rules = [ranges.compile_range(entry['range']) for entry in catalog]
+
+    conn = sqlite3.connect(db_path)
+    # Throwaway data: durability is not worth paying for here
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    migrations.migrate(conn)
+
+    started = time.perf_counter()
+    conn.executemany(
+        'INSERT INTO labs (name, slogan, address, phone, email) VALUES (?, ?, ?, ?, ?)',
+        [
+            (f'Bench Lab {i}', 'Accurate results, every time', f'{i} Bench Street', f'555-010{i}', f'lab{i}@bench.test')
+            for i in range(1, labs + 1)
+        ],
+    )
+
+    first_id = (conn.execute('SELECT COALESCE(MAX(id), 0) FROM patients').fetchone()[0]) + 1
+    # One byte each keeps 10M patients' demographics cheap to hold
+    genders = bytearray(patients)
+    ages = bytearray(patients)
+    for start in range(0, patients, CHUNK_SIZE):
+        rows = []
+        for i in range(start, min(start + CHUNK_SIZE, patients)):
+            genders[i] = rng.randrange(len(GENDERS))
+            ages[i] = rng.randrange(0, 95)
+            gender, age = GENDERS[genders[i]], ages[i]
+            rows.append((
+                f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                age,
+                gender,
+                f'9{rng.randrange(10 ** 9):09d}',
+                f'patient{first_id + i}@bench.test',
+                f'BP{first_id + i:09d}',
+                f'{rng.randrange(1, 999)} Synthetic Road',
+                _timestamp(now, rng, days),
+            ))
+        conn.executemany('''
+            INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+    log(f'patients: {patients} in {time.perf_counter() - started:.1f}s')
+
+    started = time.perf_counter()
+    for start in range(0, tests, CHUNK_SIZE):
+        rows = []
+        for _ in range(start, min(start + CHUNK_SIZE, tests)):
+            index = rng.randrange(patients)
+            gender, age = GENDERS[genders[index]], ages[index]
+            item = rng.randrange(len(catalog))
+            entry = catalog[item]
+            value = synth_value(rules[item], rng, gender, age)
+            rows.append([
+                first_id + index,
+                entry['category'],
+                entry['name'],
+                value,
+                entry['range'],
+                entry['unit'],
+                '',
+                _timestamp(now, rng, days),
+                rules[item].classify(value, gender, age),
+            ])
+        conn.executemany('''
+            INSERT INTO tests (patient_id, test_category, test_name, test_value, normal_range, unit,
+                               additional_note, created_at, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        if (start // CHUNK_SIZE) % 50 == 49:
+            log(f'  tests: {start + len(rows)}')
+    log(f'tests: {tests} in {time.perf_counter() - started:.1f}s')
+
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='SQLite file to create or extend')
+    parser.add_argument('--patients', type=int, default=10000)
+    parser.add_argument('--tests', type=int, default=100000)
+    parser.add_argument('--labs', type=int, default=3)
+    parser.add_argument('--days', type=int, default=730, help='spread created_at over this many days')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    generate(args.db, args.patients, args.tests, args.labs, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""Drive every API route and record latency, throughput and memory.
+
+Run from the backend directory against a generated database::
+
+    python -m bench.generate --db /tmp/bench.db --patients 10000 --tests 100000
+    python -m bench.harness --db /tmp/bench.db --output baseline.json
+    python -m bench.harness --db /tmp/bench.db --compare baseline.json
+
+By default requests go through the Flask test client in this process. Use
+--url to target a running server instead (--server-pid adds its peak RSS).
+Write routes insert and delete rows, so point this at a throwaway database.
+
+Peak RSS is per endpoint on Linux, where the kernel's high-water mark is
+reset before each one; elsewhere it is the process peak so far.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+DEFAULT_TOLERANCE = 0.2
+
+
+class FlaskClient:
+    def __init__(self, db_path):
+        os.environ['MEDLAB_DB'] = db_path
+        import app as medlab
+        self.app = medlab.app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None, content_type=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, data=body, headers=headers or {}, content_type=content_type)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None, content_type=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def _sample(conn, sql, count):
+    return [row[0] for row in conn.execute(sql, (count,))]
+
+
+class Workload:
+    """Request factories for every route, fed with ids from the database."""
+
+    def __init__(self, db_path, seed):
+        self.rng = random.Random(seed)
+        conn = sqlite3.connect(db_path)
+        self.patient_ids = _sample(conn, 'SELECT id FROM patients ORDER BY random() LIMIT ?', 1000)
+        self.patient_codes = _sample(conn, 'SELECT patient_code FROM patients ORDER BY random() LIMIT ?', 1000)
+        self.names = _sample(conn, 'SELECT full_name FROM patients ORDER BY random() LIMIT ?', 200)
+        # Deleted by the DELETE /api/tests workload, newest first
+        self.test_ids = _sample(conn, 'SELECT id FROM tests ORDER BY id DESC LIMIT ?', 100000)
+        cursor = conn.execute('SELECT created_at, id FROM tests ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET 500').fetchone()
+        self.test_cursor = f'{cursor[0]},{cursor[1]}' if cursor else ''
+        placeholders = ', '.join('?' * len(self.patient_ids[:200]))
+        self.trends = conn.execute(
+            f'SELECT DISTINCT patient_id, test_name FROM tests WHERE patient_id IN ({placeholders})',
+            self.patient_ids[:200],
+        ).fetchall() or [(self.patient_ids[0] if self.patient_ids else 0, 'Hemoglobin (Hb)')]
+        # A page of recent changes; later writes only add to the log
+        self.changes_cursor = max(0, conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0] - 100)
+        conn.close()
+        # Set by main() after signing in, for routes behind require_auth
+        self.token = ''
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def _next(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def patient(self):
+        n = self._next()
+        return {
+            'fullName': f'Bench Patient {n}', 'age': 40, 'gender': 'female', 'contactNumber': '9000000000',
+            'email': f'bench{n}@bench.test', 'patientCode': f'BENCH-{os.getpid()}-{time.time_ns()}-{n}',
+            'address': '1 Bench Street',
+        }
+
+    def lab(self):
+        n = self._next()
+        return {
+            'name': f'Bench Lab {n}', 'slogan': 'Benchmarked', 'address': '1 Bench Street',
+            'phone': '555-0100', 'email': f'lab{n}@bench.test',
+        }
+
+    def test(self):
+        return {
+            'patientId': self.rng.choice(self.patient_ids), 'testCategory': 'Hematology Tests',
+            'testName': 'Hemoglobin (Hb)', 'testValue': round(self.rng.uniform(9, 17), 1),
+            'normalRange': 'M: 13–16; F: 11.5–14.5', 'unit': 'g/dL',
+        }
+
+    def endpoints(self):
+        rng = self.rng
+        as_json = lambda payload: (json.dumps(payload), 'application/json')
+
+        def delete_test():
+            with self.lock:
+                test_id = self.test_ids.pop() if self.test_ids else 0
+            return 'DELETE', f'/api/tests/{test_id}', None
+
+        def trend():
+            patient_id, test_name = rng.choice(self.trends)
+            return 'GET', f'/api/patients/{patient_id}/trends?test={urllib.parse.quote(test_name)}', None
+
+        pdf_batch = lambda: as_json({'patientIds': rng.sample(self.patient_ids, min(10, len(self.patient_ids)))})
+
+        return [
+            ('GET /api/patients?limit=100', lambda: ('GET', '/api/patients?limit=100', None)),
+            ('GET /api/patients (full)', lambda: ('GET', '/api/patients', None)),
+            ('GET /api/tests?limit=100', lambda: ('GET', '/api/tests?limit=100', None)),
+            ('GET /api/tests?after', lambda: ('GET', f'/api/tests?limit=100&after={self.test_cursor}', None)),
+            ('GET /api/tests?stream=ndjson', lambda: ('GET', '/api/tests?stream=ndjson&limit=1000', None)),
+            ('GET /api/tests?format=columnar', lambda: ('GET', '/api/tests?format=columnar&limit=1000', None)),
+            ('GET /api/tests?status=High', lambda: ('GET', '/api/tests?status=High&limit=100', None)),
+            ('GET /api/labs', lambda: ('GET', '/api/labs', None)),
+            ('GET /api/patient-report/<code>', lambda: ('GET', f'/api/patient-report/{rng.choice(self.patient_codes)}', None)),
+            ('GET /api/reports/<id>', lambda: ('GET', f'/api/reports/{rng.choice(self.patient_ids)}', None)),
+            ('GET /api/reports/<id>/pdf', lambda: ('GET', f'/api/reports/{rng.choice(self.patient_ids)}/pdf', None)),
+            ('POST /api/reports/pdf/batch', lambda: ('POST', '/api/reports/pdf/batch', pdf_batch())),
+            ('GET /api/patients/<id>/trends', lambda: ('GET', f'/api/patients/{rng.choice(self.patient_ids)}/trends', None)),
+            ('GET /api/patients/<id>/trends?test', trend),
+            ('GET /api/patients/search', lambda: ('GET', f'/api/patients/search?q={urllib.parse.quote(rng.choice(self.names)[:4])}', None)),
+            ('GET /api/stats', lambda: ('GET', '/api/stats', None)),
+            ('GET /api/stats/analytics', lambda: ('GET', '/api/stats/analytics', None)),
+            ('GET /api/changes', lambda: ('GET', '/api/changes', None)),
+            ('GET /api/changes?since', lambda: ('GET', f'/api/changes?since={self.changes_cursor}&limit=100', None)),
+            ('GET /metrics', lambda: ('GET', '/metrics', None)),
+            ('POST /api/patients', lambda: ('POST', '/api/patients', as_json(self.patient()))),
+            ('POST /api/tests', lambda: ('POST', '/api/tests', as_json(self.test()))),
+            ('POST /api/tests/batch', lambda: ('POST', '/api/tests/batch', as_json([self.test() for _ in range(100)]))),
+            ('POST /api/patients/batch', lambda: ('POST', '/api/patients/batch', as_json([self.patient() for _ in range(100)]))),
+            ('DELETE /api/tests/<id>', delete_test),
+            ('POST /api/labs', lambda: ('POST', '/api/labs', as_json(self.lab()))),
+            ('POST /api/signup', lambda: ('POST', '/api/signup', as_json({'email': f'u{self._next()}@bench.test', 'password': 'benchpass'}))),
+            ('POST /api/SignIn', lambda: ('POST', '/api/SignIn', as_json({'email': 'signin@bench.test', 'password': 'benchpass'}))),
+            ('GET /api/me', lambda: ('GET', '/api/me', None, {'Authorization': f'Bearer {self.token}'})),
+        ]
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _reset_peak_rss(server_pid=None):
+    """Reset the high-water mark to the current RSS; False where that is unsupported.
+
+    Writing 5 to clear_refs does this on Linux 4.0 and later.
+    """
+    try:
+        with open(f'/proc/{server_pid or "self"}/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb(server_pid=None):
+    try:
+        with open(f'/proc/{server_pid or "self"}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if server_pid:
+        return None
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_endpoint(client, make_request, requests, concurrency, server_pid=None):
+    latencies = []
+    errors = 0
+    total_bytes = 0
+    lock = threading.Lock()
+
+    def one(_):
+        nonlocal errors, total_bytes
+        # Factories return (method, path, payload) plus optional headers
+        method, path, payload, *headers = make_request()
+        body, content_type = payload if payload else (None, None)
+        started = time.perf_counter()
+        status, data = client.request(method, path, body, headers[0] if headers else None, content_type)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            total_bytes += len(data)
+            if status >= 400:
+                errors += 1
+
+    per_endpoint = _reset_peak_rss(server_pid)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'throughput_rps': round(requests / wall, 1) if wall else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)),
+        'p50_ms': ms(_percentile(latencies, 0.50)),
+        'p95_ms': ms(_percentile(latencies, 0.95)),
+        'p99_ms': ms(_percentile(latencies, 0.99)),
+        'bytes_per_request': total_bytes // requests,
+        'peak_rss_kb': _peak_rss_kb(server_pid),
+        'peak_rss_scope': 'endpoint' if per_endpoint else 'process',
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print a comparison table and return the endpoints that regressed."""
+    regressions = []
+    print(f'{"endpoint":40} {"p95 base":>10} {"p95 now":>10} {"rps base":>10} {"rps now":>10}')
+    for name, current in results['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        flag = ''
+        slower = previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance)
+        fewer = previous['throughput_rps'] and current['throughput_rps'] < previous['throughput_rps'] / (1 + tolerance)
+        if slower or fewer:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(
+            f'{name:40} {previous["p95_ms"]:>10} {current["p95_ms"]:>10} '
+            f'{previous["throughput_rps"]:>10} {current["throughput_rps"]:>10}{flag}'
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='database generated by bench.generate')
+    parser.add_argument('--url', help='base URL of a running server, e.g. http://localhost:5000')
+    parser.add_argument('--server-pid', type=int, help='with --url, report this process\'s peak RSS per endpoint')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--only', help='substring filter on endpoint names')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown before flagging a regression (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    client = HttpClient(args.url) if args.url else FlaskClient(args.db)
+    workload = Workload(args.db, args.seed)
+    # Seed the account used by the sign-in workload, and sign in for /api/me
+    account = json.dumps({'email': 'signin@bench.test', 'password': 'benchpass'})
+    client.request('POST', '/api/signup', account, content_type='application/json')
+    status, data = client.request('POST', '/api/SignIn', account, content_type='application/json')
+    if status == 200:
+        workload.token = json.loads(data)['token']
+
+    conn = sqlite3.connect(args.db)
+    scale = {
+        'patients': conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0],
+        'tests': conn.execute('SELECT COUNT(*) FROM tests').fetchone()[0],
+    }
+    conn.close()
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'mode': 'http' if args.url else 'flask',
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'scale': scale,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': {},
+    }
+    for name, make_request in workload.endpoints():
+        if args.only and args.only not in name:
+            continue
+        stats = run_endpoint(client, make_request, args.requests, args.concurrency, args.server_pid)
+        results['results'][name] = stats
+        print(f'{name:40} {stats["throughput_rps"]:>9} rps  p50 {stats["p50_ms"]:>8} ms  '
+              f'p95 {stats["p95_ms"]:>8} ms  p99 {stats["p99_ms"]:>8} ms  errors {stats["errors"]}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
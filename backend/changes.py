@@ -0,0 +1,693 @@
+"""Change log of every write, served as pages and as Server-Sent Events.
+
+Triggers append a row to ``changes`` for each insert, update and delete of
+patients, tests and labs, so clients can apply deltas instead of reloading
+whole tables. ``seq`` grows in commit order within a database file and,
+like row ids, shard n's sequence starts at n << 40; a cursor is the last seq
+seen from each shard, joined with commas.
+
+Open streams never poll the database. One hub thread per process reads new
+changes (every POLL_INTERVAL, or straight after a write in this process),
+expands them once and wakes every stream (through one Condition, and through
+listeners for the stream server), so an idle stream holds no connection.
+
+Streams are served by StreamServer, a small asyncio HTTP server that
+serve_streams() starts on MEDLAB_STREAM_PORT next to the Flask app. There
+an open stream is a coroutine rather than a server thread, and a process
+holds up to MEDLAB_MAX_STREAMS of them. The Flask route still streams for
+clients that cannot reach that port, but each of those holds a server
+thread, so it takes at most MEDLAB_MAX_THREADED_STREAMS and answers 503 past
+that; refused clients page through ``?since=`` until a stream frees up.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from flask import Response, current_app, jsonify, request
+
+import db
+import shards
+from shards import ID_BITS
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+
+POLL_INTERVAL = float(os.environ.get('MEDLAB_CHANGES_POLL_SECONDS', '0.5'))
+HEARTBEAT_SECONDS = 15
+# Streams end after this long and the client reconnects with Last-Event-ID,
+# which spreads long-lived connections across workers
+STREAM_SECONDS = int(os.environ.get('MEDLAB_STREAM_SECONDS', '300'))
+MAX_STREAMS = int(os.environ.get('MEDLAB_MAX_STREAMS', '1000'))
+# Streams through the Flask route hold a server thread each; keep this well
+# below the server's thread count so regular requests always find one
+MAX_THREADED_STREAMS = int(os.environ.get('MEDLAB_MAX_THREADED_STREAMS', '50'))
+STREAM_PORT = int(os.environ.get('MEDLAB_STREAM_PORT', '5001'))
+# Requests to the stream server must send their headers within this long
+REQUEST_TIMEOUT = 10
+RETRY_MS = 3000
+BUFFER_SIZE = 10000
+RETENTION_DAYS = int(os.environ.get('MEDLAB_CHANGES_RETENTION_DAYS', '30'))
+
+EVENT_STREAM = 'text/event-stream'
+KEEPALIVE = ': keepalive\n\n'
+
+logger = logging.getLogger('medlab.changes')
+
+CHANGES_SQL = '''
+    SELECT seq, table_name, op, row_id, lab_id, created_at FROM changes
+    WHERE seq > ?
+    ORDER BY seq
+    LIMIT ?
+'''
+
+LAB_CHANGES_SQL = '''
+    SELECT seq, table_name, op, row_id, lab_id, created_at FROM changes
+    WHERE seq > ? AND lab_id = ?
+    ORDER BY seq
+    LIMIT ?
+'''
+
+# Entries left after deletes carry no row data
+EXPANDED_OPS = ('insert', 'update')
+
+
+class CursorError(ValueError):
+    pass
+
+
+class CursorExpired(LookupError):
+    """The changes after this cursor were pruned, or it is from another database."""
+
+
+class HubFull(RuntimeError):
+    pass
+
+
+def parse_cursor(raw):
+    """``'12,1099511627790'`` -> ``{0: 12, 1: 1099511627790}``."""
+    cursor = {}
+    for part in raw.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            seq = int(part)
+        except ValueError:
+            raise CursorError('Invalid cursor, expected comma-separated sequence numbers')
+        if seq < 0:
+            raise CursorError('Invalid cursor, expected comma-separated sequence numbers')
+        cursor[seq >> ID_BITS] = seq
+    return cursor
+
+
+def format_cursor(cursor):
+    return ','.join(str(cursor[shard]) for shard in sorted(cursor))
+
+
+def _start(shard):
+    return shard << ID_BITS
+
+
+def head(conn, shard):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return max(row[0], _start(shard)) if row else _start(shard)
+
+
+def check_cursor(conn, shard, since):
+    """Raise CursorExpired unless the log still holds every change after ``since``."""
+    oldest = conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+    latest = head(conn, shard)
+    floor = oldest - 1 if oldest is not None else latest
+    if since < floor or since > latest:
+        raise CursorExpired(f'Cursor {since} is no longer available; reload and start from a new cursor')
+
+
+def expand(conn, rows, queries):
+    """Turn change rows into events, attaching each changed row's current fields.
+
+    ``queries`` maps table names to their ListQuery. Rows deleted since the
+    change was logged come back with ``data`` null; their delete follows.
+    """
+    wanted = {}
+    for row in rows:
+        if row[2] in EXPANDED_OPS and row[1] in queries:
+            wanted.setdefault(row[1], set()).add(row[3])
+    found = {}
+    for table, ids in wanted.items():
+        query = queries[table]
+        names = list(query.columns)
+        for values in conn.execute(query.by_ids(names, len(ids)), list(ids)):
+            found[table, values[-1]] = dict(zip(names, values))
+    return [
+        {
+            'seq': seq,
+            'table': table,
+            'op': op,
+            'id': row_id,
+            'labId': lab_id,
+            'at': created_at,
+            'data': found.get((table, row_id)),
+        }
+        for seq, table, op, row_id, lab_id, created_at in rows
+    ]
+
+
+def read(conn, since, limit, queries, lab_id=None):
+    """Return ``(events, more)`` for up to ``limit`` changes after ``since``."""
+    if lab_id is None:
+        rows = conn.execute(CHANGES_SQL, (since, limit + 1)).fetchall()
+    else:
+        rows = conn.execute(LAB_CHANGES_SQL, (since, lab_id, limit + 1)).fetchall()
+    return expand(conn, rows[:limit], queries), len(rows) > limit
+
+
+def prune(conn, days=RETENTION_DAYS):
+    """Drop log entries older than ``days``; clients holding older cursors must reload."""
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+    # seq and created_at grow together, so the cutoff is a seq range
+    row = conn.execute('SELECT seq FROM changes WHERE created_at >= ? ORDER BY seq LIMIT 1', (cutoff,)).fetchone()
+    if row is None:
+        deleted = conn.execute('DELETE FROM changes').rowcount
+    else:
+        deleted = conn.execute('DELETE FROM changes WHERE seq < ?', (row[0],)).rowcount
+    conn.commit()
+    return deleted
+
+
+class ChangeHub:
+    """Reads new changes once per process and hands them to every open stream.
+
+    Events are kept in an in-memory list; each stream remembers its position
+    in it. A stream that falls further behind than BUFFER_SIZE events reads
+    from the database instead.
+    """
+
+    def __init__(self, router, queries, interval=POLL_INTERVAL, buffer_size=BUFFER_SIZE,
+                 max_streams=MAX_STREAMS, max_threaded=MAX_THREADED_STREAMS):
+        self.router = router
+        self.queries = queries
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.max_streams = max_streams
+        self.max_threaded = max_threaded
+        self._cond = threading.Condition()
+        self._events = []
+        self._offset = 0
+        self._heads = {}
+        self._streams = 0
+        self._threaded = 0
+        self._listeners = []
+        self._wake = threading.Event()
+        self._poll_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def end(self):
+        return self._offset + len(self._events)
+
+    def _read_heads(self):
+        heads = {}
+        for shard, path in self.router.shards():
+            with db.get_pool(path).connection() as conn:
+                heads[shard] = head(conn, shard)
+        return heads
+
+    def full(self, threaded=False):
+        if threaded and self.max_threaded and self._threaded >= self.max_threaded:
+            return True
+        return bool(self.max_streams) and self._streams >= self.max_streams
+
+    def subscribe(self, threaded=False):
+        """Register a stream; return ``(position, cursor)`` to follow from.
+
+        ``threaded`` streams hold a server thread and count against
+        max_threaded as well.
+        """
+        with self._poll_lock, self._cond:
+            if self.full(threaded):
+                raise HubFull('Too many open change streams')
+            if not self._streams:
+                # Nothing was polled while idle; start from what is committed now
+                self._heads = self._read_heads()
+            self._streams += 1
+            self._threaded += threaded
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='change-hub', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return self.end, dict(self._heads)
+
+    def unsubscribe(self, threaded=False):
+        with self._cond:
+            self._streams -= 1
+            self._threaded -= threaded
+
+    def add_listener(self, listener):
+        """Call ``listener()`` on the hub thread whenever new events arrive."""
+        self._listeners.append(listener)
+
+    def notify(self):
+        if self._streams:
+            self._wake.set()
+
+    def events_after(self, position):
+        """Return ``(events, end)``, or ``(None, end)`` if ``position`` was trimmed."""
+        with self._cond:
+            if position < self._offset:
+                return None, self.end
+            return self._events[position - self._offset:], self.end
+
+    def wait(self, position, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.end > position, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._streams > 0)
+            try:
+                self._poll()
+            except Exception:
+                logger.exception('polling the change log failed')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _poll(self):
+        with self._poll_lock:
+            if not self._streams:
+                return
+            with db.get_pool(self.router.main_path).connection() as conn:
+                # Pick up shards created by other workers
+                self.router.load(conn)
+            new = []
+            for shard, path in self.router.shards():
+                since = self._heads.setdefault(shard, _start(shard))
+                with db.get_pool(path).connection() as conn:
+                    while True:
+                        events, more = read(conn, since, DEFAULT_LIMIT, self.queries)
+                        new.extend(events)
+                        if events:
+                            since = events[-1]['seq']
+                        if not more:
+                            break
+                self._heads[shard] = since
+            if new:
+                with self._cond:
+                    self._events.extend(new)
+                    overflow = len(self._events) - self.buffer_size
+                    if overflow > 0:
+                        del self._events[:overflow]
+                        self._offset += overflow
+                    self._cond.notify_all()
+                for listener in self._listeners:
+                    listener()
+
+
+def hub():
+    return current_app.extensions['changes']
+
+
+def notify():
+    """Wake this process's streams after a write instead of waiting for the next poll."""
+    hub().notify()
+
+
+def _targets(router, lab_id):
+    if lab_id is None:
+        return router.shards()
+    shard = router.shard_for_lab(lab_id)
+    return [(shard, router.path(shard))]
+
+
+def _page(router, queries, cursor, limit, lab_id):
+    """Up to ``limit`` changes after ``cursor``, shard by shard, in seq order within each."""
+    events = []
+    for shard, path in _targets(router, lab_id):
+        since = cursor.get(shard, _start(shard))
+        with db.get_pool(path).connection() as conn:
+            check_cursor(conn, shard, since)
+            if len(events) == limit:
+                return events, True
+            shard_events, more = read(conn, since, limit - len(events), queries, lab_id)
+        events.extend(shard_events)
+        if more:
+            return events, True
+    return events, False
+
+
+def _advance(cursor, event):
+    cursor[event['seq'] >> ID_BITS] = event['seq']
+    return format_cursor(cursor)
+
+
+def _sse(event_id=None, data=None, event=None):
+    lines = []
+    if event:
+        lines.append(f'event: {event}')
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class Follower:
+    """One stream's place in the hub's buffer and in each shard's log.
+
+    Holds no thread or connection between calls, so the same state drives
+    streams on the Flask route and on StreamServer.
+    """
+
+    def __init__(self, change_hub, cursor, lab_id, shard_ids, position, heads):
+        self.hub = change_hub
+        self.lab_id = lab_id
+        self.shard_ids = shard_ids
+        self.position = position
+        self.deadline = time.monotonic() + STREAM_SECONDS
+        # A client resuming from its own cursor first catches up from the database
+        self.resume = cursor is not None
+        if cursor is None:
+            cursor = {shard: seq for shard, seq in heads.items() if shard in shard_ids}
+        self.cursor = cursor
+
+    def opening(self):
+        return f'retry: {RETRY_MS}\n' + _sse(format_cursor(self.cursor), {'cursor': format_cursor(self.cursor)}, event='ready')
+
+    def catch_up(self):
+        """Yield one chunk per page read from the database, then follow the hub.
+
+        The hub position was taken before reading, so events already sent
+        are skipped by pending().
+        """
+        more = True
+        while more:
+            events, more = _page(self.hub.router, self.hub.queries, self.cursor, MAX_LIMIT, self.lab_id)
+            if events:
+                yield ''.join(_sse(_advance(self.cursor, event), event) for event in events)
+        self.resume = False
+
+    def pending(self):
+        """Return the hub's new events for this stream; sets ``resume`` if it fell behind."""
+        events, end = self.hub.events_after(self.position)
+        if events is None:
+            self.position, self.resume = end, True
+            return ''
+        self.position = end
+        chunks = []
+        for event in events:
+            shard = event['seq'] >> ID_BITS
+            if shard not in self.shard_ids or event['seq'] <= self.cursor.get(shard, _start(shard)):
+                continue
+            if self.lab_id is not None and event['labId'] != self.lab_id:
+                continue
+            chunks.append(_sse(_advance(self.cursor, event), event))
+        return ''.join(chunks)
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+
+def _stream(change_hub, cursor, lab_id, shard_ids):
+    try:
+        position, heads = change_hub.subscribe(threaded=True)
+    except HubFull as e:
+        yield _sse(None, {'error': str(e)}, event='busy')
+        return
+    try:
+        follower = Follower(change_hub, cursor, lab_id, shard_ids, position, heads)
+        yield follower.opening()
+        while True:
+            if follower.resume:
+                yield from follower.catch_up()
+            chunk = follower.pending()
+            if chunk:
+                yield chunk
+            if follower.resume:
+                continue
+            remaining = follower.remaining()
+            if remaining <= 0:
+                return
+            if not change_hub.wait(follower.position, min(HEARTBEAT_SECONDS, remaining)):
+                yield KEEPALIVE
+    except CursorExpired as e:
+        yield _sse(None, {'error': str(e)}, event='reset')
+    finally:
+        change_hub.unsubscribe(threaded=True)
+
+
+def changes_response():
+    """Serve ``/api/changes``: a page of changes, or an event stream.
+
+    ``?since=<cursor>`` returns the changes after it with the next cursor;
+    without it the response only carries the current cursor, for clients
+    that have just loaded the full tables. ``Accept: text/event-stream``
+    follows changes live; EventSource resumes from ``Last-Event-ID``.
+    """
+    change_hub = hub()
+    lab_id = shards.lab_id()
+    raw = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        cursor = parse_cursor(raw) if raw else None
+        limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+        if limit < 1:
+            raise CursorError('limit must be positive')
+        targets = _targets(change_hub.router, lab_id)
+    except CursorError as e:
+        return jsonify({'error': str(e)}), 400
+    except shards.UnknownLab as e:
+        return jsonify({'error': str(e)}), 404
+
+    if request.accept_mimetypes.best == EVENT_STREAM:
+        if change_hub.full(threaded=True):
+            return jsonify({'error': 'Too many open change streams'}), 503, {'Retry-After': str(RETRY_MS // 1000)}
+        shard_ids = {shard for shard, _ in targets}
+        response = Response(_stream(change_hub, cursor, lab_id, shard_ids), mimetype=EVENT_STREAM)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stop nginx and similar proxies from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    try:
+        if cursor is None:
+            heads = {}
+            for shard, path in targets:
+                with db.get_pool(path).connection() as conn:
+                    heads[shard] = head(conn, shard)
+            return jsonify({'changes': [], 'cursor': format_cursor(heads), 'more': False})
+        events, more = _page(change_hub.router, change_hub.queries, cursor, min(limit, MAX_LIMIT), lab_id)
+    except CursorExpired as e:
+        return jsonify({'error': str(e)}), 410
+    except db.PoolTimeout:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    for event in events:
+        _advance(cursor, event)
+    return jsonify({'changes': events, 'cursor': format_cursor(cursor), 'more': more})
+
+
+def init_app(app, queries):
+    """Serve changes for ``app``; ``queries`` maps table names to their ListQuery."""
+    app.extensions['changes'] = ChangeHub(app.extensions['shards'], queries)
+
+
+# Event streams without a thread each
+
+MAX_HEADERS = 100
+
+STREAM_HEADERS = (
+    ('Content-Type', EVENT_STREAM),
+    ('Cache-Control', 'no-cache'),
+    ('X-Accel-Buffering', 'no'),
+)
+
+# EventSource sends Last-Event-ID when it reconnects, which needs a preflight
+# across origins
+PREFLIGHT_HEADERS = (
+    ('Access-Control-Allow-Methods', 'GET'),
+    ('Access-Control-Allow-Headers', 'Last-Event-ID, Cache-Control'),
+    ('Access-Control-Max-Age', '600'),
+)
+
+
+async def _read_head(reader):
+    """Return ``(method, target, headers)`` of an HTTP/1.x request."""
+    parts = (await reader.readline()).decode('latin-1').split()
+    if len(parts) != 3:
+        raise ValueError('Malformed request line')
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', '\n', ''):
+            return parts[0], parts[1], headers
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    raise ValueError('Too many headers')
+
+
+async def _hangup(reader):
+    # Clients send nothing after the request, so this returns when they hang
+    # up; streams end then instead of at the next failed write
+    try:
+        await reader.read(1)
+    except ConnectionError:
+        pass
+
+
+def _head(status, headers=()):
+    lines = [f'HTTP/1.1 {status}', 'Access-Control-Allow-Origin: *', 'Connection: close']
+    lines.extend(f'{name}: {value}' for name, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def _send_json(writer, status, data, headers=()):
+    body = json.dumps(data).encode('utf-8')
+    writer.write(_head(status, [('Content-Type', 'application/json'), ('Content-Length', len(body)), *headers]) + body)
+    await writer.drain()
+
+
+class StreamServer:
+    """Serves ``GET /api/changes`` event streams from one asyncio loop.
+
+    Takes the same ``since``/``labId`` parameters and Last-Event-ID as the
+    Flask route. Subscribing and catching up read the database, so they run
+    on the loop's default executor; following the hub does not.
+    """
+
+    def __init__(self, change_hub, host='127.0.0.1', port=STREAM_PORT):
+        self.hub = change_hub
+        self.host = host
+        self.port = port
+        self._changed = None
+        self._loop = None
+
+    def start(self):
+        # Bind here so a taken port fails the caller; worker processes share
+        # the port where the platform allows it
+        sock = socket.create_server((self.host, self.port), reuse_port=hasattr(socket, 'SO_REUSEPORT'))
+        self.port = sock.getsockname()[1]
+        ready = threading.Event()
+        thread = threading.Thread(target=asyncio.run, args=(self._serve(sock, ready),), name='change-streams', daemon=True)
+        thread.start()
+        ready.wait()
+        return thread
+
+    async def _serve(self, sock, ready):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.hub.add_listener(self._notify)
+        server = await asyncio.start_server(self._handle, sock=sock)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def _notify(self):
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        # Waiters hold the old event; later waits get a fresh one
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, headers = await asyncio.wait_for(_read_head(reader), REQUEST_TIMEOUT)
+            await self._respond(reader, writer, method, target, headers)
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        except Exception:
+            logger.exception('serving a change stream failed')
+        finally:
+            writer.close()
+
+    async def _respond(self, reader, writer, method, target, headers):
+        url = urlsplit(target)
+        if url.path != '/api/changes':
+            return await _send_json(writer, '404 Not Found', {'error': 'Not found'})
+        if method == 'OPTIONS':
+            writer.write(_head('204 No Content', PREFLIGHT_HEADERS))
+            return await writer.drain()
+        if method != 'GET':
+            return await _send_json(writer, '405 Method Not Allowed', {'error': 'Method not allowed'}, [('Allow', 'GET')])
+
+        args = parse_qs(url.query)
+        raw = headers.get('last-event-id') or args.get('since', [None])[0]
+        try:
+            lab_id = int(args['labId'][0])
+        except (KeyError, ValueError):
+            lab_id = None
+        retry = [('Retry-After', str(RETRY_MS // 1000))]
+        try:
+            follower = await asyncio.get_running_loop().run_in_executor(None, self._open, raw, lab_id)
+        except CursorError as e:
+            return await _send_json(writer, '400 Bad Request', {'error': str(e)})
+        except shards.UnknownLab as e:
+            return await _send_json(writer, '404 Not Found', {'error': str(e)})
+        except (HubFull, db.PoolTimeout) as e:
+            return await _send_json(writer, '503 Service Unavailable', {'error': str(e)}, retry)
+
+        try:
+            writer.write(_head('200 OK', STREAM_HEADERS))
+            writer.write(follower.opening().encode('utf-8'))
+            await writer.drain()
+            await self._follow(reader, writer, follower)
+        except CursorExpired as e:
+            writer.write(_sse(None, {'error': str(e)}, event='reset').encode('utf-8'))
+            await writer.drain()
+        finally:
+            self.hub.unsubscribe()
+
+    def _open(self, raw, lab_id):
+        cursor = parse_cursor(raw) if raw else None
+        shard_ids = {shard for shard, _ in _targets(self.hub.router, lab_id)}
+        position, heads = self.hub.subscribe()
+        return Follower(self.hub, cursor, lab_id, shard_ids, position, heads)
+
+    async def _follow(self, reader, writer, follower):
+        loop = asyncio.get_running_loop()
+        hangup = asyncio.ensure_future(_hangup(reader))
+        try:
+            while True:
+                if follower.resume:
+                    pages = follower.catch_up()
+                    while True:
+                        chunk = await loop.run_in_executor(None, next, pages, None)
+                        if chunk is None:
+                            break
+                        writer.write(chunk.encode('utf-8'))
+                        await writer.drain()
+                chunk = follower.pending()
+                if chunk:
+                    writer.write(chunk.encode('utf-8'))
+                    await writer.drain()
+                if follower.resume:
+                    continue
+                remaining = follower.remaining()
+                if remaining <= 0:
+                    return
+                # Take the event before checking, so a wake in between is not lost
+                changed = self._changed
+                if self.hub.end > follower.position:
+                    continue
+                wake = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait((wake, hangup), timeout=min(HEARTBEAT_SECONDS, remaining),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                wake.cancel()
+                if hangup in done:
+                    return
+                if not done:
+                    writer.write(KEEPALIVE.encode('utf-8'))
+                    await writer.drain()
+        finally:
+            hangup.cancel()
+
+
+def serve_streams(app, host='127.0.0.1', port=STREAM_PORT):
+    """Serve ``app``'s change streams on ``port`` from a background thread."""
+    server = StreamServer(app.extensions['changes'], host, port)
+    server.start()
+    return server
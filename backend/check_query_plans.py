@@ -0,0 +1,111 @@
+"""Fail if any route query needs a full table scan or a temp sort.
+
+Run from the backend directory: ``python check_query_plans.py``. A fresh,
+fully migrated database is created in a temp directory, so this can run in
+CI without touching patients.db.
+
+Besides the route queries this covers patient search (FTS5 must answer from
+its index) and the stats rollups, including the lookups their triggers make
+on every write.
+"""
+import os
+import re
+import sys
+import tempfile
+
+os.environ['MEDLAB_DB'] = os.path.join(tempfile.mkdtemp(), 'plans.db')
+
+import app as medlab  # noqa: E402
+import archive  # noqa: E402
+import changes  # noqa: E402
+from db import get_pool  # noqa: E402
+import search  # noqa: E402
+import stats  # noqa: E402
+import trends  # noqa: E402
+
+# A handful of rows each (one per counter, or per gender and age group);
+# reading them whole is what they are for
+ROLLUP_TABLES = ('stats_counters', 'patient_demographics')
+
+# bm25 ranking sorts at most search.MAX_RANKED_MATCHES rows; broader
+# searches use the newest-first plan, which must not sort
+BOUNDED_SORTS = ('search_patients?ranked', 'search_patients?ranked&labId')
+
+# FTS5 lists the constraints it uses after the colon; none means every row
+UNCONSTRAINED_VTAB = re.compile(r'VIRTUAL TABLE INDEX \d+:$')
+
+
+def route_queries():
+    queries = [
+        ('get_patient_report', 'SELECT * FROM patients WHERE patient_code = ?', ('P1',)),
+        ('get_labs', 'SELECT * FROM labs ORDER BY created_at DESC', ()),
+        ('generate_report', 'SELECT * FROM patients WHERE id = ?', (1,)),
+        ('generate_report', archive.tests_sql(medlab.REPORT_TEST_COLUMNS), (1,)),
+        ('archive.patient_tests', archive.tests_sql(('id', 'created_at'), by_name=True), (1, 'HbA1c')),
+        ('get_patient_trends', trends.SUMMARY_SQL, (1,)),
+        ('get_patient_trends?test', trends.HISTORY_SQL, (1, 'HbA1c', '', '9999-12-31 23:59:59')),
+        ('signin', 'SELECT id, password FROM users WHERE email = ?', ('a@b.c',)),
+        ('get_changes', changes.CHANGES_SQL, (0, 500)),
+        ('get_changes?labId', changes.LAB_CHANGES_SQL, (0, 1, 500)),
+        ('search_patients', search.MATCH_SQL, ('"jo"*', search.MAX_RANKED_MATCHES + 1)),
+        ('search_patients?ranked', search.results_sql(search.RANKED_ORDER), ('"jo"*', 20)),
+        ('search_patients?ranked&labId', search.results_sql(search.RANKED_ORDER, by_lab=True), ('"jo"*', 1, 20)),
+        ('search_patients?newest', search.results_sql(search.NEWEST_ORDER), ('"jo"*', 20)),
+        ('search_patients?newest&labId', search.results_sql(search.NEWEST_ORDER, by_lab=True), ('"jo"*', 1, 20)),
+        ('get_stats', stats.COUNTERS_SQL, ()),
+        ('get_stats', stats.TESTS_SINCE_SQL, ('2024-01-01',)),
+        ('get_analytics', stats.DEMOGRAPHICS_SQL, ()),
+        # Trigger bodies cannot be explained directly; these repeat their lookups
+        ('stats triggers', 'UPDATE stats_counters SET value = value + 1 WHERE name = ?', ('tests',)),
+        ('stats triggers', 'SELECT tests FROM patient_test_counts WHERE patient_id = ?', (1,)),
+        ('stats triggers', 'UPDATE patient_test_counts SET tests = tests - 1 WHERE patient_id = ?', (1,)),
+        ('stats triggers', 'UPDATE patient_demographics SET patients = patients - 1 WHERE gender = ? AND age_group = ?',
+         ('Male', '18-35 years')),
+        ('stats triggers', 'UPDATE daily_test_counts SET tests = tests - 1 WHERE day = date(?)', ('2024-01-01 10:00:00',)),
+        ('stats triggers', "SELECT value FROM archive_state WHERE name = 'moving'", ()),
+    ]
+    for table, query in (('patients', medlab.PATIENT_LIST), ('tests', medlab.TEST_LIST), ('labs', medlab.LAB_FIELDS)):
+        queries.append((f'changes.expand {table}', query.by_ids(list(query.columns), 2), (1, 2)))
+    cursor = ('2024-01-01 00:00:00', 1)
+    for name, query in (('get_patients', medlab.PATIENT_LIST), ('get_tests', medlab.TEST_LIST)):
+        fields = list(query.columns)
+        queries.append((name, *query.sql(fields)))
+        queries.append((f'{name}?limit', *query.sql(fields, limit=100)))
+        queries.append((f'{name}?after', *query.sql(fields, after=cursor, limit=100)))
+        for arg, column in query.filters.items():
+            queries.append((f'{name}?{arg}', *query.sql(fields, limit=100, where={column: 'x'})))
+    return queries
+
+
+def plan_problems(conn, sql, params, sort_ok=False):
+    problems = []
+    for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params):
+        detail = row[-1]
+        if 'VIRTUAL TABLE' in detail:
+            if UNCONSTRAINED_VTAB.search(detail):
+                problems.append(detail)
+        # Scans of a subquery's output (window functions) read no table
+        elif detail.startswith('SCAN') and 'USING' not in detail and '(subquery-' not in detail:
+            if detail.split()[1] not in ROLLUP_TABLES:
+                problems.append(detail)
+        if 'USE TEMP B-TREE' in detail and not sort_ok:
+            problems.append(detail)
+    return problems
+
+
+def main():
+    failed = False
+    with get_pool(medlab.app.config['DATABASE']).connection() as conn:
+        for name, sql, params in route_queries():
+            problems = plan_problems(conn, sql, params, sort_ok=name in BOUNDED_SORTS)
+            if problems:
+                failed = True
+                print(f'{name}: {"; ".join(problems)}')
+    if failed:
+        return 1
+    print('All route queries use indexes.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+from metrics import InstrumentedConnection
+
+DEFAULT_DATABASE = os.environ.get('MEDLAB_DB', 'patients.db')
+DEFAULT_POOL_SIZE = int(os.environ.get('MEDLAB_DB_POOL_SIZE', '8'))
+# How long a request waits for a free connection before giving up with a 503
+DEFAULT_POOL_TIMEOUT = float(os.environ.get('MEDLAB_DB_POOL_TIMEOUT', '10'))
+
+# How long a writer waits for the write lock instead of failing with
+# "database is locked"; sqlite3 installs it as the busy timeout
+BUSY_TIMEOUT = 5.0
+
+# Applied to every new connection. WAL lets readers run alongside the single
+# writer.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+)
+
+STATEMENT_CACHE_SIZE = 256
+
+
+def connect(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=InstrumentedConnection,
+    )
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, path, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return connect(self.path)
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f'No database connection became free within {self.timeout:g}s')
+
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next borrower
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    path = path or DEFAULT_DATABASE
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+
+def current_pool():
+    # g.database is set when the request was routed to a lab's shard
+    return get_pool(g.get('database') or current_app.config.get('DATABASE'))
+
+
+def get_db():
+    """Borrow a pooled connection for the current app context.
+
+    The connection is returned to the pool by the teardown hook registered
+    in init_app, so routes never have to close it themselves.
+    """
+    if 'db' not in g:
+        g.db_pool = current_pool()
+        g.db = g.db_pool.acquire()
+    return g.db
+
+
+def get_main_db():
+    """Borrow a connection to the main database (labs, users, shard map).
+
+    Same as get_db() unless the request was routed to another shard.
+    """
+    main = current_app.config.get('DATABASE')
+    if g.get('database') in (None, main):
+        return get_db()
+    if 'main_db' not in g:
+        g.main_db = get_pool(main).acquire()
+    return g.main_db
+
+
+@contextmanager
+def connection_for(path):
+    """A connection to ``path``, reusing one this request already holds.
+
+    Taking a second connection from a pool the request is holding one of
+    can wait forever once the pool is drained.
+    """
+    if path == current_pool().path:
+        yield get_db()
+    elif path == current_app.config.get('DATABASE'):
+        yield get_main_db()
+    else:
+        with get_pool(path).connection() as conn:
+            yield conn
+
+
+def release_db(exc=None):
+    conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if conn is not None:
+        pool.release(conn)
+    main_conn = g.pop('main_db', None)
+    if main_conn is not None:
+        get_pool(current_app.config.get('DATABASE')).release(main_conn)
+
+
+@contextmanager
+def transaction(conn=None):
+    conn = conn or get_db()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', DEFAULT_DATABASE)
+    app.teardown_appcontext(release_db)
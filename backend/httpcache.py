@@ -0,0 +1,159 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Response, request
+
+from db import get_main_db
+import formats
+import shards
+
+MAX_ENTRIES = 256
+# Entries are evicted once their bodies add up to more than MAX_BYTES, and
+# bodies above MAX_ENTRY_BYTES (a full test list) are never stored
+MAX_BYTES = int(os.environ.get('MEDLAB_RESPONSE_CACHE_BYTES', str(64 << 20)))
+MAX_ENTRY_BYTES = int(os.environ.get('MEDLAB_RESPONSE_CACHE_ENTRY_BYTES', str(4 << 20)))
+CACHED_HEADERS = ('Content-Encoding', 'Vary')
+
+
+def table_versions(conn, tables):
+    """Return ``(versions, last_modified)`` for the given tables.
+
+    The counters live in table_versions and are bumped by triggers, so they
+    reflect writes from every worker process, not just this one.
+    """
+    placeholders = ', '.join('?' * len(tables))
+    rows = conn.execute(
+        f'SELECT name, version, modified_at FROM table_versions WHERE name IN ({placeholders})', tables
+    ).fetchall()
+    versions = {name: version for name, version, _ in rows}
+    stamps = [modified_at for _, _, modified_at in rows if modified_at]
+    last_modified = None
+    if stamps:
+        last_modified = datetime.strptime(max(stamps), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return tuple(versions.get(table, 0) for table in tables), last_modified
+
+
+class ResponseCache:
+    """Thread-safe LRU of serialized response bodies, bounded by count and bytes.
+
+    Keys include the table versions, so an entry can never be served after
+    one of its tables changed; invalidate() just frees that memory early.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, max_entry_bytes=MAX_ENTRY_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, tables, body, mimetype, headers):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (tables, body, mimetype, headers)
+            self.size += len(body)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self.size -= len(entry[1])
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def invalidate(self, table):
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if table in entry[0]]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+response_cache = ResponseCache()
+
+
+def invalidate(*tables):
+    for table in tables:
+        response_cache.invalidate(table)
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def conditional(*tables, daily=False):
+    """Answer conditional GETs for a read endpoint that depends on ``tables``.
+
+    The ETag combines the table versions with the request path, query
+    string, Accept header and response coding. ``daily`` endpoints (counts
+    for "today") also change at UTC midnight, so the date is part of their
+    ETag and Last-Modified is never older than the start of the day.
+    Matching If-None-Match/If-Modified-Since gets a 304 without running the
+    view; otherwise the serialized body comes from the LRU when possible.
+    Streamed responses and bodies over MAX_ENTRY_BYTES are never stored.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if shards.MAIN_TABLES.issuperset(tables):
+                results = [table_versions(get_main_db(), tables)]
+            else:
+                # One entry per shard when the read spans several
+                results = shards.query(lambda conn: table_versions(conn, tables))
+            versions = tuple(v for v, _ in results)
+            stamps = [lm for _, lm in results if lm]
+            last_modified = max(stamps) if stamps else None
+            variant = f'{request.full_path}|{request.headers.get("Accept", "")}|{formats.negotiate_encoding()}'
+            if daily:
+                midnight = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+                variant += f'|{midnight.date()}'
+                last_modified = max(last_modified, midnight) if last_modified else midnight
+            etag = hashlib.sha1(f'{versions}|{variant}'.encode('utf-8')).hexdigest()
+
+            if _not_modified(etag, last_modified):
+                response = Response(status=304)
+            else:
+                entry = response_cache.get(etag)
+                if entry is not None:
+                    _, body, mimetype, headers = entry
+                    response = Response(body, mimetype=mimetype, headers=headers)
+                else:
+                    response = view(*args, **kwargs)
+                    if isinstance(response, tuple) or response.status_code != 200:
+                        return response
+                    if not response.is_streamed:
+                        # Cache the compressed body so hits skip compression
+                        formats.compress(response)
+                        # Keep pagination and similar headers alongside the body
+                        headers = [(k, v) for k, v in response.headers.items() if k.startswith('X-') or k in CACHED_HEADERS]
+                        response_cache.put(etag, tables, response.get_data(), response.mimetype, headers)
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # Let browsers keep the body but revalidate on every use
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
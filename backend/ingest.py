@@ -0,0 +1,291 @@
+import csv
+import json
+import sqlite3
+
+from flask import request
+
+import ranges
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+# SQLite integers are signed 64-bit
+MIN_INTEGER = -(1 << 63)
+MAX_INTEGER = (1 << 63) - 1
+
+PATIENT_FIELDS = ['fullName', 'age', 'gender', 'contactNumber', 'email', 'patientCode', 'address']
+TEST_FIELDS = ['patientId', 'testCategory', 'testName', 'testValue', 'normalRange', 'unit']
+
+INSERT_PATIENT = '''
+    INSERT INTO patients (full_name, age, gender, contact_number, email, patient_code, address, lab_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# A test belongs to its patient's lab
+INSERT_TEST = '''
+    INSERT INTO tests (patient_id, test_category, test_name, test_value, normal_range, unit, additional_note, status,
+                       lab_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT lab_id FROM patients WHERE id = ?1))
+'''
+
+PATIENT_NOT_FOUND = 'Patient not found'
+INVALID_UTF8 = 'Row is not valid UTF-8'
+
+
+class RowError(ValueError):
+    pass
+
+
+def _decode(lines, invalid):
+    """Yield each byte line as text, appending undecodable line numbers to ``invalid``.
+
+    Those lines are decoded with replacement characters so a CSV reader
+    keeps its place; the caller reports them as RowError.
+    """
+    for number, line in enumerate(lines, start=1):
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            invalid.append(number)
+            yield line.decode('utf-8', 'replace')
+
+
+def read_rows():
+    """Yield ``(row_number, row)`` from the request body without buffering it.
+
+    JSON arrays are parsed whole; NDJSON and CSV bodies are read line by
+    line from the request stream. Malformed lines, including ones that are
+    not valid UTF-8, are yielded as RowError so they are reported alongside
+    validation errors.
+    """
+    mimetype = request.mimetype
+    if mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            raise RowError('Expected a JSON array of rows')
+        yield from enumerate(data, start=1)
+    elif mimetype in ('application/x-ndjson', 'application/jsonl'):
+        invalid = []
+        for number, line in enumerate(_decode(request.stream, invalid), start=1):
+            if invalid and invalid[-1] == number:
+                yield number, RowError(INVALID_UTF8)
+                continue
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, RowError(f'Invalid JSON: {e}')
+    elif mimetype == 'text/csv':
+        invalid = []
+        reader = csv.DictReader(_decode(request.stream, invalid))
+        if reader.fieldnames and invalid:
+            raise RowError('CSV header is not valid UTF-8')
+        reported = 0
+        for number, row in enumerate(reader, start=1):
+            if len(invalid) > reported:
+                # The record spans a line that did not decode
+                reported = len(invalid)
+                yield number, RowError(INVALID_UTF8)
+                continue
+            yield number, {key: value for key, value in row.items() if value not in (None, '')}
+    else:
+        raise RowError(f'Unsupported content type: {mimetype}')
+
+
+def _require(row, fields):
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError('Row must be an object')
+    for field in fields:
+        if field not in row:
+            raise RowError(f'Missing required field: {field}')
+
+
+def _integer(value, field):
+    try:
+        number = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise RowError(f'{field} must be an integer')
+    if not MIN_INTEGER <= number <= MAX_INTEGER:
+        raise RowError(f'{field} is out of range')
+    return number
+
+
+def _scalar(value, field):
+    # Objects, arrays and integers wider than 64 bits cannot be bound as SQL parameters
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise RowError(f'{field} must be a string or a number')
+    if isinstance(value, int) and not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise RowError(f'{field} is out of range')
+    return value
+
+
+def patient_params(row):
+    _require(row, PATIENT_FIELDS)
+    return (
+        _scalar(row['fullName'], 'fullName'),
+        _integer(row['age'], 'age'),
+        _scalar(row['gender'], 'gender'),
+        _scalar(row['contactNumber'], 'contactNumber'),
+        _scalar(row['email'], 'email'),
+        _scalar(row['patientCode'], 'patientCode'),
+        _scalar(row['address'], 'address'),
+    )
+
+
+def test_params(row):
+    _require(row, TEST_FIELDS)
+    value = _scalar(row['testValue'], 'testValue')
+    # CSV cells arrive as text; store numeric results as numbers
+    number = ranges.to_number(value)
+    return [
+        _integer(row['patientId'], 'patientId'),
+        _scalar(row['testCategory'], 'testCategory'),
+        _scalar(row['testName'], 'testName'),
+        number if number is not None else value,
+        _scalar(row['normalRange'], 'normalRange'),
+        _scalar(row['unit'], 'unit'),
+        _scalar(row.get('additionalNote', ''), 'additionalNote'),
+        None,
+    ]
+
+
+def _patient_demographics(conn, patient_ids, cache):
+    missing = [pid for pid in set(patient_ids) if pid not in cache]
+    for start in range(0, len(missing), 500):
+        batch = missing[start:start + 500]
+        placeholders = ', '.join('?' * len(batch))
+        for pid, gender, age in conn.execute(
+            f'SELECT id, gender, age FROM patients WHERE id IN ({placeholders})', batch
+        ):
+            cache[pid] = (gender, age)
+    return cache
+
+
+def classify_tests(conn, params, cache):
+    """Fill in the status column for a chunk of test rows.
+
+    Returns an error message for each row whose patient does not exist,
+    and None for the others.
+    """
+    _patient_demographics(conn, [p[0] for p in params], cache)
+    statuses = ranges.classify_batch(
+        (p[4], p[3], *cache.get(p[0], (None, None))) for p in params
+    )
+    for p, status in zip(params, statuses):
+        p[7] = status
+    return [None if p[0] in cache else PATIENT_NOT_FOUND for p in params]
+
+
+class Ingest:
+    def __init__(self, conn, insert_sql, to_params, prepare=None, chunk_size=CHUNK_SIZE):
+        self.conn = conn
+        self.insert_sql = insert_sql
+        self.to_params = to_params
+        self.prepare = prepare
+        self.chunk_size = chunk_size
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': number, 'error': message})
+
+    def flush(self, chunk):
+        if not chunk:
+            return
+        if self.prepare:
+            # prepare may reject rows by returning an error message for them
+            problems = self.prepare(self.conn, [p for _, p in chunk]) or [None] * len(chunk)
+            for (number, _), problem in zip(chunk, problems):
+                if problem:
+                    self.error(number, problem)
+            chunk = [row for row, problem in zip(chunk, problems) if not problem]
+            if not chunk:
+                return
+        numbers = [number for number, _ in chunk]
+        params = [p for _, p in chunk]
+        try:
+            self.conn.executemany(self.insert_sql, params)
+            self.conn.commit()
+            self.inserted += len(params)
+            return
+        except sqlite3.Error:
+            self.conn.rollback()
+        # Something in the chunk was rejected; retry row by row so only the
+        # offending rows fail.
+        for number, p in zip(numbers, params):
+            try:
+                self.conn.execute(self.insert_sql, p)
+                self.inserted += 1
+            except sqlite3.Error as e:
+                self.error(number, str(e))
+        self.conn.commit()
+
+    def run(self, rows):
+        chunk = []
+        for number, row in rows:
+            try:
+                chunk.append((number, self.to_params(row)))
+            except RowError as e:
+                self.error(number, str(e))
+                continue
+            if len(chunk) >= self.chunk_size:
+                self.flush(chunk)
+                chunk = []
+        self.flush(chunk)
+        return self.summary()
+
+    def summary(self):
+        return {'inserted': self.inserted, 'failed': self.failed, 'errors': self.errors}
+
+
+class ShardedIngest(Ingest):
+    """Ingest that sends each row to the shard owning ``key(params)``.
+
+    ``group`` maps keys to ``{path: keys}`` (shards.group_ids) and
+    ``connect(path)`` yields a connection to that shard. Rows whose key
+    belongs to no shard fail with ``missing``.
+    """
+
+    def __init__(self, connect, group, key, insert_sql, to_params, prepare=None, missing=PATIENT_NOT_FOUND):
+        super().__init__(None, insert_sql, to_params, prepare)
+        self.connect = connect
+        self.group = group
+        self.key = key
+        self.missing = missing
+
+    def flush(self, chunk):
+        if not chunk:
+            return
+        owners = {}
+        for path, keys in self.group([self.key(p) for _, p in chunk]).items():
+            owners.update(dict.fromkeys(keys, path))
+        by_path = {}
+        for number, p in chunk:
+            path = owners.get(self.key(p))
+            if path is None:
+                self.error(number, self.missing)
+            else:
+                by_path.setdefault(path, []).append((number, p))
+        for path, rows in by_path.items():
+            with self.connect(path) as conn:
+                self.conn = conn
+                super().flush(rows)
+
+
+def ingest_patients(conn, lab_id=None):
+    to_params = lambda row: patient_params(row) + (lab_id,)
+    return Ingest(conn, INSERT_PATIENT, to_params).run(read_rows())
+
+
+def ingest_tests(connect, group):
+    """Insert test rows on the shard that holds each row's patient."""
+    cache = {}
+    prepare = lambda conn, params: classify_tests(conn, params, cache)
+    key = lambda params: params[0]
+    return ShardedIngest(connect, group, key, INSERT_TEST, test_params, prepare).run(read_rows())
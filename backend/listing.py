@@ -0,0 +1,200 @@
+import heapq
+from contextlib import ExitStack
+from itertools import islice
+
+from flask import Response, jsonify, request, stream_with_context
+
+from db import current_pool, get_db, get_pool
+import formats
+from shards import fan_out_paths, map_paths
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class ListQueryError(ValueError):
+    pass
+
+
+class ListQuery:
+    """Keyset-paginated, projectable listing over one table or join.
+
+    ``columns`` maps API field names to SQL expressions. ``created_col`` and
+    ``id_col`` are the sort keys; rows are always returned newest first and
+    cursors are ``<created_at>,<id>`` of the last row on the page.
+    ``filters`` maps query-string arguments to columns matched by equality.
+    """
+
+    def __init__(self, columns, from_clause, created_col, id_col, filters=None):
+        self.columns = columns
+        self.from_clause = from_clause
+        self.created_col = created_col
+        self.id_col = id_col
+        self.filters = filters or {}
+
+    def fields(self, raw):
+        if not raw:
+            return list(self.columns)
+        names = [name.strip() for name in raw.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.columns]
+        if unknown:
+            raise ListQueryError(f'Unknown field(s): {", ".join(unknown)}')
+        return names
+
+    def sql(self, names, after=None, limit=None, where=None):
+        select = ', '.join(self.columns[name] for name in names)
+        sql = f'SELECT {select}, {self.created_col}, {self.id_col} FROM {self.from_clause}'
+        conditions = []
+        params = []
+        for column, value in (where or {}).items():
+            conditions.append(f'{column} = ?')
+            params.append(value)
+        if after is not None:
+            conditions.append(f'({self.created_col}, {self.id_col}) < (?, ?)')
+            params.extend(after)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += f' ORDER BY {self.created_col} DESC, {self.id_col} DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return sql, params
+
+    def by_ids(self, names, count):
+        """SQL selecting ``names`` plus the id for ``count`` ids, in no particular order."""
+        select = ', '.join(self.columns[name] for name in names)
+        placeholders = ', '.join('?' * count)
+        return f'SELECT {select}, {self.id_col} FROM {self.from_clause} WHERE {self.id_col} IN ({placeholders})'
+
+
+def parse_cursor(raw):
+    if not raw:
+        return None
+    created_at, sep, row_id = raw.rpartition(',')
+    if not sep:
+        raise ListQueryError('Invalid cursor, expected <created_at>,<id>')
+    try:
+        return created_at, int(row_id)
+    except ValueError:
+        raise ListQueryError('Invalid cursor, expected <created_at>,<id>')
+
+
+def parse_limit(raw, default=None):
+    if raw is None or raw == '':
+        return default
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise ListQueryError('limit must be an integer')
+    if limit < 1:
+        raise ListQueryError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def stream_format():
+    fmt = request.args.get('stream')
+    if fmt:
+        if fmt not in STREAM_FORMATS:
+            raise ListQueryError(f'Unsupported stream format: {fmt}')
+        return fmt
+    if request.accept_mimetypes.best == STREAM_FORMATS['ndjson']:
+        return 'ndjson'
+    return None
+
+
+def _encode_cursor(row):
+    return f'{row[-2]},{row[-1]}'
+
+
+def _iter_rows(conn, sql, params):
+    cursor = conn.execute(sql, params)
+    while True:
+        batch = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not batch:
+            break
+        yield from batch
+
+
+def _sort_key(row):
+    return row[-2] or '', row[-1]
+
+
+def _merged_rows(paths, sql, params, limit=None):
+    # Each shard returns rows newest first, so a k-way merge keeps the order
+    rows = heapq.merge(*map_paths(lambda conn: conn.execute(sql, params).fetchall(), paths),
+                       key=_sort_key, reverse=True)
+    return list(islice(rows, limit))
+
+
+def _stream(paths, sql, params, names, fmt):
+    dumps = formats.dumps
+    with ExitStack() as stack:
+        sources = [_iter_rows(stack.enter_context(get_pool(path).connection()), sql, params) for path in paths]
+        rows = sources[0] if len(sources) == 1 else heapq.merge(*sources, key=_sort_key, reverse=True)
+        if fmt == 'ndjson':
+            for row in rows:
+                yield dumps(dict(zip(names, row))) + b'\n'
+            return
+        yield b'['
+        first = True
+        for row in rows:
+            chunk = dumps(dict(zip(names, row)))
+            yield chunk if first else b',' + chunk
+            first = False
+        yield b']'
+
+
+def list_response(query):
+    """Serve a list endpoint from request args.
+
+    Without ``after``/``limit``/``stream`` the full list is returned as a
+    plain JSON array, which is what the existing frontend expects. With
+    ``limit`` or ``after`` a single page is returned and the cursor for the
+    next page is sent in the ``X-Next-Cursor`` header. With ``stream`` (or an
+    ``Accept: application/x-ndjson`` header) rows are streamed straight from
+    the cursor in batches. Reads spanning several shards are merged in
+    created_at order, so cursors work across shards too. ``format=columnar``
+    returns the rows as columns (see formats).
+    """
+    try:
+        names = query.fields(request.args.get('fields'))
+        where = {column: request.args[arg] for arg, column in query.filters.items() if arg in request.args}
+        after = parse_cursor(request.args.get('after'))
+        paged = after is not None or 'limit' in request.args
+        fmt = stream_format()
+        limit = parse_limit(request.args.get('limit'), DEFAULT_PAGE_SIZE if paged and not fmt else None)
+        body_format = formats.requested_format()
+        if fmt and body_format == 'columnar':
+            raise ListQueryError('Columnar responses cannot be streamed')
+    except (ListQueryError, formats.FormatError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    paths = fan_out_paths()
+    if fmt:
+        sql, params = query.sql(names, after, limit, where)
+        return Response(
+            stream_with_context(_stream(paths or [current_pool().path], sql, params, names, fmt)),
+            mimetype=STREAM_FORMATS[fmt],
+        )
+
+    # Fetch one extra row to know whether another page exists
+    sql, params = query.sql(names, after, limit + 1 if limit else None, where)
+    if paths:
+        rows = _merged_rows(paths, sql, params, limit + 1 if limit else None)
+    else:
+        rows = get_db().execute(sql, params).fetchall()
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1])
+
+    response = formats.rows_response(names, rows, body_format)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
@@ -0,0 +1,354 @@
+import bisect
+import logging
+import os
+import sqlite3
+import threading
+from time import perf_counter
+
+from flask import Response, request
+
+SLOW_REQUEST_SECONDS = float(os.environ.get('MEDLAB_SLOW_REQUEST_MS', '500')) / 1000
+SLOW_QUERY_SECONDS = float(os.environ.get('MEDLAB_SLOW_QUERY_MS', '100')) / 1000
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+ITER_BATCH_SIZE = 256
+
+# Statements shown per slow request, slowest first
+SLOW_REQUEST_STATEMENTS = 3
+
+slow_log = logging.getLogger('medlab.slow')
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = sorted((k, list(v)) for k, v in self._series.items())
+        for label_values, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = _labels(self.labels + ('le',), label_values + (_format(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format(series[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+REQUESTS = Counter('medlab_http_requests_total', 'Requests served.', ('method', 'route', 'status'))
+REQUEST_SECONDS = Histogram(
+    'medlab_http_request_duration_seconds', 'Time from request start to response.', ('method', 'route')
+)
+RESPONSE_BYTES = Histogram(
+    'medlab_http_response_bytes', 'Response body size.', ('method', 'route'), BYTE_BUCKETS
+)
+SQL_STATEMENTS = Histogram(
+    'medlab_sql_statements_per_request', 'SQL statements executed per request.', ('method', 'route'), COUNT_BUCKETS
+)
+SQL_SECONDS = Histogram(
+    'medlab_sql_duration_seconds_per_request', 'Time spent executing SQL and fetching rows per request.',
+    ('method', 'route')
+)
+SQL_ROWS = Histogram(
+    'medlab_sql_rows_fetched_per_request', 'Rows fetched from SQLite per request.', ('method', 'route'), ROW_BUCKETS
+)
+SLOW_REQUESTS = Counter('medlab_slow_requests_total', 'Requests slower than the slow-request threshold.', ('route',))
+SLOW_QUERIES = Counter('medlab_slow_queries_total', 'Statements slower than the slow-query threshold.')
+
+REGISTRY = [REQUESTS, REQUEST_SECONDS, RESPONSE_BYTES, SQL_STATEMENTS, SQL_SECONDS, SQL_ROWS, SLOW_REQUESTS, SLOW_QUERIES]
+
+
+class RequestStats:
+    __slots__ = ('started', 'statements', 'sql_seconds', 'rows', 'by_sql', '_lock')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        # sql -> [executions, seconds]; repeated statements show up as N+1 queries
+        self.by_sql = {}
+        self._lock = threading.Lock()
+
+    def merge(self, other):
+        with self._lock:
+            self.statements += other.statements
+            self.sql_seconds += other.sql_seconds
+            self.rows += other.rows
+            for sql, (executed, seconds) in other.by_sql.items():
+                entry = self.by_sql.setdefault(sql, [0, 0.0])
+                entry[0] += executed
+                entry[1] += seconds
+
+
+_local = threading.local()
+
+
+def _current():
+    return getattr(_local, 'stats', None)
+
+
+def current_stats():
+    """The RequestStats of the request running on this thread, if any."""
+    return _current()
+
+
+def run_for(stats, fn, *args):
+    """Call ``fn(*args)`` on a worker thread, charging its SQL to ``stats``.
+
+    The worker counts into its own RequestStats and merges it when done, so
+    workers running in parallel for one request never share counters.
+    """
+    if stats is None:
+        return fn(*args)
+    previous = _current()
+    _local.stats = own = RequestStats()
+    try:
+        return fn(*args)
+    finally:
+        _local.stats = previous
+        stats.merge(own)
+
+
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def _explain(conn, sql, parameters):
+    if parameters is None or not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return ''
+    try:
+        # A plain cursor so the plan lookup is not itself instrumented
+        rows = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return f'(no plan: {e})'
+    return '\n'.join(f'  {row[-1]}' for row in rows)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that charges execute and fetch time to the current request.
+
+    SQLite steps lazily, so most of a query's cost is paid while fetching;
+    fetch time is attributed to the statement that produced the rows.
+    """
+
+    _sql = None
+    _parameters = ()
+    _elapsed = 0.0
+    _logged = False
+
+    def execute(self, sql, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql, self._parameters, self._elapsed, self._logged = sql, parameters, 0.0, False
+            self._record(perf_counter() - started, 0, executed=1)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql, self._parameters, self._elapsed, self._logged = sql, None, 0.0, False
+            self._record(perf_counter() - started, 0, executed=1)
+
+    def fetchone(self):
+        started = perf_counter()
+        row = super().fetchone()
+        self._record(perf_counter() - started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = super().fetchall()
+        self._record(perf_counter() - started, len(rows))
+        return rows
+
+    def __iter__(self):
+        # Timing every row would cost more than fetching it; time batches instead
+        while True:
+            rows = self.fetchmany(ITER_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def _record(self, elapsed, rows, executed=0):
+        self._elapsed += elapsed
+        stats = _current()
+        if stats is not None:
+            stats.statements += executed
+            stats.sql_seconds += elapsed
+            stats.rows += rows
+            entry = stats.by_sql.get(self._sql)
+            if entry is None:
+                entry = stats.by_sql[self._sql] = [0, 0.0]
+            entry[0] += executed
+            entry[1] += elapsed
+        if self._elapsed >= SLOW_QUERY_SECONDS and not self._logged and self._sql is not None:
+            self._logged = True
+            SLOW_QUERIES.inc()
+            plan = _explain(self.connection, self._sql, self._parameters)
+            slow_log.warning(
+                'slow query %.1f ms: %s\nparams: %r\n%s',
+                self._elapsed * 1000, ' '.join(self._sql.split()), self._parameters, plan,
+            )
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection's shortcuts build a plain Cursor, bypassing cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _route():
+    rule = request.url_rule
+    return request.method, rule.rule if rule is not None else 'unmatched'
+
+
+def _start_request():
+    _local.stats = RequestStats()
+
+
+def _finish(stats, labels, status, size, long_lived=False):
+    elapsed = perf_counter() - stats.started
+    REQUESTS.inc(labels + (status,))
+    REQUEST_SECONDS.observe(labels, elapsed)
+    if size is not None:
+        RESPONSE_BYTES.observe(labels, size)
+    SQL_STATEMENTS.observe(labels, stats.statements)
+    SQL_SECONDS.observe(labels, stats.sql_seconds)
+    SQL_ROWS.observe(labels, stats.rows)
+    if elapsed >= SLOW_REQUEST_SECONDS and not long_lived:
+        SLOW_REQUESTS.inc(labels[1:])
+        slowest = sorted(stats.by_sql.items(), key=lambda item: item[1][1], reverse=True)[:SLOW_REQUEST_STATEMENTS]
+        slow_log.warning(
+            'slow request %s %s %.1f ms: status %s, %s statements in %.1f ms, %s rows, %s bytes%s',
+            labels[0], labels[1], elapsed * 1000, status, stats.statements, stats.sql_seconds * 1000,
+            stats.rows, size if size is not None else '?',
+            ''.join(
+                f'\n  {count}x {seconds * 1000:.1f} ms: {" ".join(sql.split())}'
+                for sql, (count, seconds) in slowest if sql
+            ),
+        )
+    return elapsed
+
+
+def _counting(body, stats, labels, status, long_lived):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        _finish(stats, labels, status, size, long_lived)
+        if _current() is stats:
+            _local.stats = None
+
+
+def _finish_request(response):
+    stats = _current()
+    if stats is None:
+        return response
+    labels = _route()
+    if response.is_streamed:
+        # Rows are still to be fetched; account for them as the body is sent
+        # Event streams stay open by design; they are not slow requests
+        long_lived = response.mimetype == 'text/event-stream'
+        response.response = _counting(response.response, stats, labels, str(response.status_code), long_lived)
+        return response
+    _local.stats = None
+    size = response.calculate_content_length()
+    elapsed = _finish(stats, labels, str(response.status_code), size)
+    # Splits the time seen in browser devtools between SQLite and Python
+    response.headers['Server-Timing'] = (
+        f'db;dur={stats.sql_seconds * 1000:.1f}, app;dur={(elapsed - stats.sql_seconds) * 1000:.1f}'
+    )
+    return response
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Record request and SQL metrics for every request to ``app``.
+
+    Metrics are kept per process; with several workers, scrape each one or
+    aggregate in Prometheus.
+    """
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
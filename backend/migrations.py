@@ -0,0 +1,279 @@
+import ranges
+import stats
+
+# Schema migrations, applied in order. The index of the last applied
+# migration is kept in PRAGMA user_version, so existing databases are
+# upgraded in place and each migration runs exactly once. Only ever append
+# to this list; never edit or reorder a migration that has shipped.
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+@migration
+def create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            full_name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            contact_number TEXT NOT NULL,
+            email TEXT NOT NULL,
+            patient_code TEXT NOT NULL UNIQUE,
+            address TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            test_category TEXT NOT NULL,
+            test_name TEXT NOT NULL,
+            test_value REAL NOT NULL,
+            normal_range TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            additional_note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS labs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            slogan TEXT,
+            address TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            email TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )
+    ''')
+
+
+@migration
+def add_test_status(conn):
+    if 'status' not in _columns(conn, 'tests'):
+        conn.execute('ALTER TABLE tests ADD COLUMN status TEXT')
+    ranges.backfill(conn)
+
+
+@migration
+def add_hot_query_indexes(conn):
+    # generate_report: WHERE patient_id = ? ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tests_patient_created ON tests (patient_id, created_at)')
+    # get_tests and its keyset pagination: ORDER BY created_at DESC, id DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tests_created ON tests (created_at)')
+    # get_tests?status=
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tests_status_created ON tests (status, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_patients_created ON patients (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_labs_created ON labs (created_at)')
+    conn.execute('ANALYZE')
+
+
+@migration
+def add_table_versions(conn):
+    # Bumped by triggers on every write; read endpoints derive their ETag and
+    # Last-Modified validators from these rows.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            modified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for table in ('patients', 'tests', 'labs'):
+        conn.execute('INSERT OR IGNORE INTO table_versions (name) VALUES (?)', (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS version_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE table_versions SET version = version + 1, modified_at = CURRENT_TIMESTAMP
+                    WHERE name = '{table}';
+                END
+            ''')
+
+
+@migration
+def add_patient_search_index(conn):
+    # External-content FTS5 index over patients; prefix indexes make short
+    # typeahead queries cheap.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            full_name, patient_code, contact_number, email,
+            content='patients', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients
+        BEGIN
+            INSERT INTO patients_fts (rowid, full_name, patient_code, contact_number, email)
+            VALUES (NEW.id, NEW.full_name, NEW.patient_code, NEW.contact_number, NEW.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients
+        BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, full_name, patient_code, contact_number, email)
+            VALUES ('delete', OLD.id, OLD.full_name, OLD.patient_code, OLD.contact_number, OLD.email);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update
+        AFTER UPDATE OF full_name, patient_code, contact_number, email ON patients
+        BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, full_name, patient_code, contact_number, email)
+            VALUES ('delete', OLD.id, OLD.full_name, OLD.patient_code, OLD.contact_number, OLD.email);
+            INSERT INTO patients_fts (rowid, full_name, patient_code, contact_number, email)
+            VALUES (NEW.id, NEW.full_name, NEW.patient_code, NEW.contact_number, NEW.email);
+        END
+    ''')
+    conn.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+
+
+@migration
+def add_trend_index(conn):
+    # Trends and delta checks: one patient's history for one test, in order
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_tests_patient_name_created ON tests (patient_id, test_name, created_at)'
+    )
+    conn.execute('ANALYZE tests')
+
+
+@migration
+def add_test_archive(conn):
+    # Yearly archive files written by archive.py, and which of them hold
+    # tests for each patient, so reads only open the archives they need
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archives (
+            period TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            tests INTEGER NOT NULL DEFAULT 0,
+            oldest TIMESTAMP,
+            newest TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_manifest (
+            patient_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            tests INTEGER NOT NULL,
+            abnormal INTEGER NOT NULL,
+            PRIMARY KEY (patient_id, period)
+        ) WITHOUT ROWID
+    ''')
+    # Set only inside the archiver's delete transaction
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO archive_state (name, value) VALUES ('moving', 0)")
+
+
+@migration
+def add_lab_scope(conn):
+    # Patients and tests belong to a lab; NULL is the pre-sharding default
+    for table in ('patients', 'tests'):
+        if 'lab_id' not in _columns(conn, table):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN lab_id INTEGER')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_lab_created ON {table} (lab_id, created_at)')
+    # Shard map, only populated in the main database
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shards (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS lab_shards (
+            lab_id INTEGER PRIMARY KEY,
+            shard_id INTEGER NOT NULL REFERENCES shards (id)
+        )
+    ''')
+
+
+@migration
+def add_change_log(conn):
+    # One row per write, in commit order, for clients that apply deltas
+    # instead of reloading whole tables. AUTOINCREMENT so a seq is never reused.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            lab_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Archived tests leave the live lists but still count in reports and
+    # stats, so the archiver's deletes are logged as 'archive'
+    delete_op = {
+        'tests': "CASE WHEN (SELECT value FROM archive_state WHERE name = 'moving') IS 1 "
+                 "THEN 'archive' ELSE 'delete' END",
+    }
+    for table, lab in (('patients', 'lab_id'), ('tests', 'lab_id'), ('labs', 'id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            op = delete_op.get(table, "'delete'") if event == 'DELETE' else f"'{event.lower()}'"
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS changes_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO changes (table_name, op, row_id, lab_id)
+                    VALUES ('{table}', {op}, {row}.id, {row}.{lab});
+                END
+            ''')
+
+
+@migration
+def add_stats_rollups(conn):
+    # Dashboard rollups kept by triggers (see stats.py). Older databases got
+    # these triggers recreated on every start, outside a transaction, so
+    # their counters are recomputed here once. Changing a trigger body
+    # needs a new migration.
+    stats.create(conn)
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every pending migration, each in its own transaction.
+
+    BEGIN IMMEDIATE takes the write lock before the version is re-read, so
+    two processes starting at once cannot apply the same migration twice.
+    """
+    applied = []
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = current_version(conn)
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return applied
+            func = MIGRATIONS[version]
+            func(conn)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(func.__name__)
@@ -0,0 +1,131 @@
+import zlib
+
+# A small PDF writer for text-and-rules documents such as lab reports. It
+# only uses the standard Helvetica fonts, which every PDF viewer ships, so
+# no font embedding or third-party library is needed.
+
+PAGE_WIDTH = 595.28
+PAGE_HEIGHT = 841.89
+
+FONTS = {
+    'regular': 'Helvetica',
+    'bold': 'Helvetica-Bold',
+}
+
+# Helvetica advance widths (1/1000 em) for printable ASCII
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_BOLD_FACTOR = 1.07
+
+
+def text_width(text, size, font='regular'):
+    total = 0
+    for char in text:
+        code = ord(char)
+        total += _HELVETICA_WIDTHS[code - 32] if 32 <= code < 127 else 556
+    if font == 'bold':
+        total *= _BOLD_FACTOR
+    return total * size / 1000
+
+
+def wrap(text, width, size, font='regular'):
+    """Split text into lines that fit ``width`` points."""
+    lines = []
+    for paragraph in str(text).split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if text_width(candidate, size, font) <= width or not line:
+                line = candidate
+            else:
+                lines.append(line)
+                line = word
+        lines.append(line)
+    return lines
+
+
+def _escape(text):
+    data = str(text).encode('cp1252', errors='replace')
+    return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def _rgb(color):
+    return ' '.join(f'{c / 255:.3f}' for c in color).encode()
+
+
+class Document:
+    """Accumulates drawing operations page by page.
+
+    Coordinates are in points from the top-left corner, which is the
+    natural orientation for flowing a report downwards.
+    """
+
+    def __init__(self, width=PAGE_WIDTH, height=PAGE_HEIGHT):
+        self.width = width
+        self.height = height
+        self.pages = []
+        self.new_page()
+
+    def new_page(self):
+        self.pages.append([])
+        self.ops = self.pages[-1]
+
+    def text(self, x, y, text, size=10, font='regular', color=(0, 0, 0)):
+        self.ops.append(
+            b'BT %s rg /%s %.2f Tf %.2f %.2f Td (%s) Tj ET'
+            % (_rgb(color), FONTS[font].encode(), size, x, self.height - y - size, _escape(text))
+        )
+
+    def line(self, x1, y1, x2, y2, width=0.5, color=(0, 0, 0)):
+        self.ops.append(
+            b'%s RG %.2f w %.2f %.2f m %.2f %.2f l S'
+            % (_rgb(color), width, x1, self.height - y1, x2, self.height - y2)
+        )
+
+    def rect(self, x, y, w, h, fill=None, stroke=None, width=0.5):
+        op = b'%.2f %.2f %.2f %.2f re' % (x, self.height - y - h, w, h)
+        if fill and stroke:
+            self.ops.append(b'%s rg %s RG %.2f w %s B' % (_rgb(fill), _rgb(stroke), width, op))
+        elif fill:
+            self.ops.append(b'%s rg %s f' % (_rgb(fill), op))
+        else:
+            self.ops.append(b'%s RG %.2f w %s S' % (_rgb(stroke or (0, 0, 0)), width, op))
+
+    def render(self):
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            None,  # page tree, filled in once page ids are known
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+        ]
+        page_ids = []
+        for ops in self.pages:
+            stream = zlib.compress(b'\n'.join(ops))
+            objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(stream), stream))
+            content_id = len(objects)
+            objects.append(
+                b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+                b'/Resources << /Font << /Helvetica 3 0 R /Helvetica-Bold 4 0 R >> >> '
+                b'/Contents %d 0 R >>' % (self.width, self.height, content_id)
+            )
+            page_ids.append(len(objects))
+        kids = b' '.join(b'%d 0 R' % pid for pid in page_ids)
+        objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(page_ids))
+
+        out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(out))
+            out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+        xref = len(out)
+        out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        for offset in offsets:
+            out += b'%010d 00000 n \n' % offset
+        out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+        return bytes(out)
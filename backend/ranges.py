@@ -0,0 +1,238 @@
+import re
+from functools import lru_cache
+
+# Statuses that count as an abnormal result in reports and analytics
+ABNORMAL_STATUSES = ('High', 'Low', 'Positive', 'Abnormal')
+
+QUALITATIVE_TERMS = {
+    'negative': 'Negative',
+    'positive': 'Positive',
+    'normal': 'Normal',
+    'abnormal': 'Abnormal',
+    'reactive': 'Positive',
+    'non-reactive': 'Negative',
+    'nonreactive': 'Negative',
+}
+
+SEX_LABELS = {
+    'm': 'M', 'male': 'M', 'men': 'M',
+    'f': 'F', 'female': 'F', 'women': 'F',
+}
+
+# Age bands (inclusive, in years) for age-qualified ranges such as
+# "Adult: 0.5–2; Infant: 2–6"
+AGE_LABELS = {
+    'newborn': (0, 0),
+    'infant': (0, 1),
+    'child': (1, 17),
+    'children': (1, 17),
+    'adult': (18, None),
+    'adults': (18, None),
+    'elderly': (65, None),
+}
+
+_NUMBER = r'(\d+(?:\.\d+)?)'
+_INTERVAL_RE = re.compile(rf'^{_NUMBER}\s*-\s*{_NUMBER}')
+_BELOW_RE = re.compile(rf'^(<=?|≤)\s*{_NUMBER}')
+_ABOVE_RE = re.compile(rf'^(>=?|≥)\s*{_NUMBER}')
+_UP_TO_RE = re.compile(rf'^up\s*to\s*{_NUMBER}', re.IGNORECASE)
+_LABELLED_RE = re.compile(r'^([A-Za-z][A-Za-z .()/]*?)\s*:\s*(.+)$')
+
+
+def to_number(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _qualitative_value(value):
+    if isinstance(value, str):
+        return QUALITATIVE_TERMS.get(value.strip().lower())
+    return None
+
+
+def _combine(statuses):
+    """Collapse several component statuses into one."""
+    statuses = [s for s in statuses if s is not None]
+    if not statuses:
+        return None
+    abnormal = {s for s in statuses if s in ABNORMAL_STATUSES}
+    if not abnormal:
+        return statuses[0] if len(set(statuses)) == 1 else 'Normal'
+    return abnormal.pop() if len(abnormal) == 1 else 'Abnormal'
+
+
+class Rule:
+    def classify(self, value, sex=None, age=None):
+        return None
+
+
+class Interval(Rule):
+    def __init__(self, low=None, high=None, low_strict=False, high_strict=False, qualitative=None):
+        self.low = low
+        self.high = high
+        self.low_strict = low_strict
+        self.high_strict = high_strict
+        # Ranges such as "<5 mm (negative)" also accept a qualitative result
+        self.qualitative = qualitative
+
+    def classify(self, value, sex=None, age=None):
+        number = to_number(value)
+        if number is None:
+            term = _qualitative_value(value)
+            if term and self.qualitative:
+                return term
+            return None
+        if self.low is not None and (number <= self.low if self.low_strict else number < self.low):
+            return 'Low'
+        if self.high is not None and (number >= self.high if self.high_strict else number > self.high):
+            return 'High'
+        return 'Normal'
+
+
+class Qualitative(Rule):
+    def __init__(self, expected):
+        self.expected = expected
+
+    def classify(self, value, sex=None, age=None):
+        term = _qualitative_value(value)
+        if term is None:
+            return None
+        if self.expected == 'Normal':
+            return 'Normal' if term in ('Normal', 'Negative') else 'Abnormal'
+        return term
+
+
+class BySex(Rule):
+    def __init__(self, rules):
+        self.rules = rules
+
+    def classify(self, value, sex=None, age=None):
+        key = SEX_LABELS.get(str(sex or '').strip().lower())
+        if key in self.rules:
+            return self.rules[key].classify(value, sex, age)
+        # Unknown sex: only report a status every range agrees on
+        statuses = {rule.classify(value, sex, age) for rule in self.rules.values()}
+        return statuses.pop() if len(statuses) == 1 else None
+
+
+class ByAge(Rule):
+    def __init__(self, bands):
+        self.bands = bands
+
+    def classify(self, value, sex=None, age=None):
+        years = to_number(age)
+        if years is not None:
+            for (low, high), rule in self.bands:
+                if years >= low and (high is None or years <= high):
+                    return rule.classify(value, sex, age)
+        statuses = {rule.classify(value, sex, age) for _, rule in self.bands}
+        return statuses.pop() if len(statuses) == 1 else None
+
+
+class MultiComponent(Rule):
+    """Ranges such as the DLC entry, one range per named component.
+
+    The value is expected in the same ``Name: value; Name: value`` shape;
+    the overall status is the combination of the component statuses.
+    """
+
+    def __init__(self, components):
+        self.components = components
+
+    def component_values(self, value):
+        values = {}
+        for part in str(value).split(';'):
+            match = _LABELLED_RE.match(part.strip())
+            if match:
+                values[match.group(1).strip().lower()] = match.group(2).strip()
+        return values
+
+    def classify(self, value, sex=None, age=None):
+        if to_number(value) is not None:
+            return None
+        values = self.component_values(value)
+        return _combine(
+            rule.classify(values[name], sex, age)
+            for name, rule in self.components.items()
+            if name in values
+        )
+
+
+def _compile_simple(text):
+    text = text.strip()
+    qualitative = next((term for key, term in QUALITATIVE_TERMS.items() if key in text.lower()), None)
+
+    match = _INTERVAL_RE.match(text)
+    if match:
+        return Interval(float(match.group(1)), float(match.group(2)), qualitative=qualitative)
+    match = _BELOW_RE.match(text)
+    if match:
+        return Interval(high=float(match.group(2)), high_strict=match.group(1) == '<', qualitative=qualitative)
+    match = _ABOVE_RE.match(text)
+    if match:
+        return Interval(low=float(match.group(2)), low_strict=match.group(1) == '>', qualitative=qualitative)
+    match = _UP_TO_RE.match(text)
+    if match:
+        return Interval(high=float(match.group(1)), qualitative=qualitative)
+    if text.lower() in QUALITATIVE_TERMS:
+        return Qualitative(QUALITATIVE_TERMS[text.lower()])
+    return Rule()
+
+
+@lru_cache(maxsize=1024)
+def compile_range(text):
+    """Compile a reference range string into a reusable Rule.
+
+    Each distinct string is parsed once; later calls hit the cache.
+    """
+    text = str(text or '').replace('–', '-').replace('—', '-').strip()
+    parts = [part.strip() for part in text.split(';') if part.strip()]
+    labelled = [_LABELLED_RE.match(part) for part in parts]
+    if not parts or not all(labelled):
+        return _compile_simple(text)
+
+    entries = [(m.group(1).strip().lower(), _compile_simple(m.group(2))) for m in labelled]
+    labels = [label for label, _ in entries]
+    if all(label in SEX_LABELS for label in labels):
+        return BySex({SEX_LABELS[label]: rule for label, rule in entries})
+    if all(label in AGE_LABELS for label in labels):
+        return ByAge([(AGE_LABELS[label], rule) for label, rule in entries])
+    return MultiComponent(dict(entries))
+
+
+def classify(normal_range, value, sex=None, age=None):
+    return compile_range(normal_range).classify(value, sex, age)
+
+
+def classify_batch(rows):
+    """Classify many ``(normal_range, value, sex, age)`` tuples at once.
+
+    Rows sharing a range string share one compiled rule, so a batch pays the
+    parsing cost once per distinct range rather than once per row.
+    """
+    rules = {}
+    statuses = []
+    for normal_range, value, sex, age in rows:
+        rule = rules.get(normal_range)
+        if rule is None:
+            rule = rules[normal_range] = compile_range(normal_range)
+        statuses.append(rule.classify(value, sex, age))
+    return statuses
+
+
+def backfill(conn):
+    """Store a status for tests inserted before statuses were persisted."""
+    rows = conn.execute('''
+        SELECT t.id, t.normal_range, t.test_value, p.gender, p.age
+        FROM tests t
+        LEFT JOIN patients p ON t.patient_id = p.id
+        WHERE t.status IS NULL
+    ''').fetchall()
+    statuses = classify_batch(row[1:] for row in rows)
+    updates = [(status, row[0]) for row, status in zip(rows, statuses) if status is not None]
+    conn.executemany('UPDATE tests SET status = ? WHERE id = ?', updates)
+    return len(updates)
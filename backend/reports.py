@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import archive
+from pdf import Document, text_width, wrap
+
+# Bump when the layout changes so cached PDFs are re-rendered
+RENDERER_VERSION = 1
+
+# Batches smaller than this are rendered in-process; the pool only pays off
+# once there is enough work to amortise handing data to the workers.
+MIN_PARALLEL_BATCH = 4
+
+MARGIN = 40
+BLUE = (25, 118, 210)
+DARK_BLUE = (13, 71, 161)
+GREY = (97, 97, 97)
+LIGHT_BLUE = (234, 242, 251)
+LIGHT_GREY = (247, 247, 247)
+RED = (211, 47, 47)
+GREEN = (56, 142, 60)
+
+COLUMNS = (
+    ('TEST NAME', 'testName', 0.34),
+    ('RESULT', 'testValue', 0.14),
+    ('UNIT', 'unit', 0.12),
+    ('REFERENCE RANGE', 'normalRange', 0.26),
+    ('STATUS', 'status', 0.14),
+)
+
+TEST_COLUMNS = ('id', 'test_category', 'test_name', 'test_value', 'normal_range', 'unit', 'status', 'created_at')
+
+DISCLAIMER = (
+    'This report contains confidential medical information. The results should be interpreted by a '
+    'qualified healthcare professional in conjunction with clinical history and other diagnostic tests. '
+    'Normal values may vary between laboratories due to differences in equipment, reagents, and '
+    'methodologies.'
+)
+
+
+def load_lab(conn, lab_id=None):
+    """The lab a report is printed for: ``lab_id``, or the newest lab."""
+    if lab_id is None:
+        lab = conn.execute('''
+            SELECT id, name, slogan, address, phone, email
+            FROM labs ORDER BY created_at DESC LIMIT 1
+        ''').fetchone()
+    else:
+        lab = conn.execute('''
+            SELECT id, name, slogan, address, phone, email
+            FROM labs WHERE id = ?
+        ''', (lab_id,)).fetchone()
+    return lab and {
+        'id': lab[0],
+        'name': lab[1],
+        'slogan': lab[2],
+        'address': lab[3],
+        'phone': lab[4],
+        'email': lab[5],
+    }
+
+
+def load_report(conn, patient_id, lab=None):
+    """Collect everything a report shows as plain, picklable data.
+
+    ``lab`` comes from load_lab, which reads the main database; patients may
+    live in a shard.
+    """
+    patient = conn.execute('''
+        SELECT id, full_name, age, gender, contact_number, patient_code
+        FROM patients WHERE id = ?
+    ''', (patient_id,)).fetchone()
+    if not patient:
+        return None
+
+    tests = archive.patient_tests(conn, patient_id, TEST_COLUMNS)
+
+    return {
+        'patient': {
+            'id': patient[0],
+            'fullName': patient[1],
+            'age': patient[2],
+            'gender': patient[3],
+            'contactNumber': patient[4],
+            'patientCode': patient[5],
+        },
+        'lab': lab,
+        'tests': [
+            {
+                'id': t[0],
+                'testCategory': t[1],
+                'testName': t[2],
+                'testValue': t[3],
+                'normalRange': t[4],
+                'unit': t[5],
+                'status': t[6],
+                'createdAt': t[7],
+            }
+            for t in tests
+        ],
+    }
+
+
+def cache_key(data):
+    """Content address of a report: changes whenever a test or the lab does."""
+    payload = json.dumps([RENDERER_VERSION, data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ReportCache:
+    """Rendered PDFs on disk, one current file per patient and lab.
+
+    Files live in a directory per patient and are named ``<lab>-<key>.pdf``;
+    storing a new key removes the stale files for the same patient and lab,
+    so the cache stays bounded and a store only lists that patient's files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, data, key):
+        lab_id = data['lab']['id'] if data['lab'] else 0
+        return os.path.join(self.directory, str(data['patient']['id']), f'{lab_id}-{key}.pdf')
+
+    def get(self, data, key):
+        try:
+            with open(self._path(data, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, data, key, body):
+        path = self._path(data, key)
+        directory, name = os.path.split(path)
+        prefix = name[:-len(f'{key}.pdf')]
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.replace(tmp, path)
+        for entry in os.listdir(directory):
+            if entry.startswith(prefix) and entry != name:
+                try:
+                    os.remove(os.path.join(directory, entry))
+                except FileNotFoundError:
+                    pass
+
+
+def _status_color(status):
+    if status in ('High', 'Low', 'Positive', 'Abnormal'):
+        return RED
+    return GREEN
+
+
+def render_report(data):
+    """Render a report dict from load_report to PDF bytes.
+
+    Kept free of database and Flask state so it can run in a worker process.
+    """
+    doc = Document()
+    width = doc.width - 2 * MARGIN
+    bottom = doc.height - MARGIN
+    y = MARGIN
+
+    lab = data['lab']
+    if lab:
+        doc.text(MARGIN, y, lab['name'].upper(), size=18, font='bold', color=DARK_BLUE)
+        y += 24
+        if lab['slogan']:
+            doc.text(MARGIN, y, lab['slogan'], size=10, color=GREY)
+            y += 14
+        for line in (lab['address'], f"{lab['phone']} | {lab['email']}"):
+            doc.text(MARGIN, y, line, size=9, color=GREY)
+            y += 12
+    y += 6
+    doc.line(MARGIN, y, MARGIN + width, y, width=1, color=BLUE)
+    y += 10
+    title = 'LABORATORY INVESTIGATION REPORT'
+    doc.text(MARGIN + (width - text_width(title, 13, 'bold')) / 2, y, title, size=13, font='bold')
+    y += 22
+    doc.line(MARGIN, y, MARGIN + width, y, width=1, color=BLUE)
+    y += 12
+
+    patient = data['patient']
+    report_date = data['tests'][0]['createdAt'] if data['tests'] else '-'
+    details = (
+        ('Name', patient['fullName'], 'Patient ID', patient['patientCode']),
+        ('Age/Sex', f"{patient['age']} Years / {patient['gender']}", 'Contact', patient['contactNumber']),
+        ('Report Date', report_date, 'Tests', str(len(data['tests']))),
+    )
+    for left_label, left, right_label, right in details:
+        doc.text(MARGIN, y, f'{left_label}:', size=10, font='bold')
+        doc.text(MARGIN + 70, y, left, size=10)
+        doc.text(MARGIN + width / 2, y, f'{right_label}:', size=10, font='bold')
+        doc.text(MARGIN + width / 2 + 70, y, right, size=10)
+        y += 15
+    y += 10
+
+    grouped = {}
+    for test in data['tests']:
+        grouped.setdefault(test['testCategory'], []).append(test)
+
+    col_x = []
+    x = MARGIN
+    for _, _, share in COLUMNS:
+        col_x.append(x)
+        x += width * share
+
+    def header(y):
+        doc.rect(MARGIN, y, width, 18, fill=LIGHT_GREY, stroke=(204, 204, 204))
+        for (label, _, _), cx in zip(COLUMNS, col_x):
+            doc.text(cx + 4, y + 5, label, size=8, font='bold')
+        return y + 18
+
+    for category, tests in grouped.items():
+        if y + 60 > bottom:
+            doc.new_page()
+            y = MARGIN
+        doc.rect(MARGIN, y, width, 20, fill=LIGHT_BLUE)
+        doc.rect(MARGIN, y, 3, 20, fill=BLUE)
+        doc.text(MARGIN + 8, y + 5, category.upper(), size=11, font='bold')
+        y = header(y + 20)
+
+        for test in tests:
+            cells = []
+            for (_, field, share), cx in zip(COLUMNS, col_x):
+                value = test[field]
+                cells.append(wrap('-' if value is None else value, width * share - 8, 9))
+            row_height = max(len(lines) for lines in cells) * 11 + 8
+            if y + row_height > bottom:
+                doc.new_page()
+                y = header(MARGIN)
+            color = _status_color(test['status'])
+            for (_, field, _), cx, lines in zip(COLUMNS, col_x, cells):
+                for i, line in enumerate(lines):
+                    if field == 'status':
+                        doc.text(cx + 4, y + 4 + i * 11, line, size=9, font='bold', color=color)
+                    elif field == 'testValue':
+                        doc.text(cx + 4, y + 4 + i * 11, line, size=9, color=color)
+                    else:
+                        doc.text(cx + 4, y + 4 + i * 11, line, size=9)
+            y += row_height
+            doc.line(MARGIN, y, MARGIN + width, y, color=(204, 204, 204))
+        y += 16
+
+    lines = wrap(DISCLAIMER, width - 16, 8)
+    if y + 20 + len(lines) * 10 > bottom:
+        doc.new_page()
+        y = MARGIN
+    doc.text(MARGIN, y, 'IMPORTANT MEDICAL DISCLAIMER', size=8, font='bold')
+    y += 12
+    for line in lines:
+        doc.text(MARGIN, y, line, size=8, color=GREY)
+        y += 10
+    doc.text(MARGIN, y + 6, 'This is a computer generated report', size=8, color=GREY)
+    return doc.render()
+
+
+def get_pdf(conn, cache, patient_id, lab=None):
+    """Return ``(key, pdf_bytes)`` for a patient, or None if not found."""
+    data = load_report(conn, patient_id, lab)
+    if data is None:
+        return None
+    key = cache_key(data)
+    body = cache.get(data, key)
+    if body is None:
+        body = render_report(data)
+        cache.put(data, key, body)
+    return key, body
+
+
+_executor = None
+
+
+def _pool(workers):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def render_batch(conn, cache, patient_ids, lab=None, workers=None):
+    """Render many reports, fanning uncached ones out to a process pool.
+
+    Returns ``{patient_id: pdf_bytes}`` for every patient that exists.
+    """
+    results = {}
+    pending = []
+    for patient_id in patient_ids:
+        data = load_report(conn, patient_id, lab)
+        if data is None:
+            continue
+        key = cache_key(data)
+        body = cache.get(data, key)
+        if body is None:
+            pending.append((patient_id, data, key))
+        else:
+            results[patient_id] = body
+
+    if len(pending) < MIN_PARALLEL_BATCH:
+        bodies = [render_report(data) for _, data, _ in pending]
+    else:
+        bodies = _pool(workers).map(render_report, [data for _, data, _ in pending], chunksize=4)
+    for (patient_id, data, key), body in zip(pending, bodies):
+        cache.put(data, key, body)
+        results[patient_id] = body
+    return results
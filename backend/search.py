@@ -0,0 +1,72 @@
+import re
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# bm25 scores every matching row, so a very broad prefix ("jo") against a
+# large table would cost time proportional to the match count. Above this
+# many matches the results are returned newest first instead, which FTS5
+# can stream straight from its index.
+MAX_RANKED_MATCHES = 1000
+
+# bm25 weights for full_name, patient_code, contact_number, email
+COLUMN_WEIGHTS = (10.0, 8.0, 4.0, 2.0)
+
+MATCH_SQL = 'SELECT rowid FROM patients_fts WHERE patients_fts MATCH ? LIMIT ?'
+RANKED_ORDER = 'bm25(patients_fts, ' + ', '.join(str(w) for w in COLUMN_WEIGHTS) + ')'
+NEWEST_ORDER = 'patients_fts.rowid DESC'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query where every term is a prefix.
+
+    Terms are quoted, so user input can never inject FTS5 syntax.
+    "jo smi" becomes ``"jo"* "smi"*``, which matches John Smith.
+    """
+    tokens = _TOKEN_RE.findall(query or '')
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def results_sql(order, by_lab=False):
+    lab_filter = 'AND p.lab_id = ?' if by_lab else ''
+    return f'''
+        SELECT p.id, p.full_name, p.age, p.gender, p.contact_number, p.email,
+               p.patient_code, p.address, p.created_at
+        FROM patients_fts
+        JOIN patients p ON p.id = patients_fts.rowid
+        WHERE patients_fts MATCH ? {lab_filter}
+        ORDER BY {order}
+        LIMIT ?
+    '''
+
+
+def search_patients(conn, query, limit=DEFAULT_LIMIT, lab_id=None):
+    expression = match_expression(query)
+    if not expression:
+        return []
+    matches = conn.execute(MATCH_SQL, (expression, MAX_RANKED_MATCHES + 1)).fetchall()
+    if not matches:
+        return []
+    order = NEWEST_ORDER if len(matches) > MAX_RANKED_MATCHES else RANKED_ORDER
+
+    params = [expression]
+    if lab_id is not None:
+        params.append(lab_id)
+    params.append(min(limit, MAX_LIMIT))
+    rows = conn.execute(results_sql(order, lab_id is not None), params).fetchall()
+    return [
+        {
+            'id': row[0],
+            'fullName': row[1],
+            'age': row[2],
+            'gender': row[3],
+            'contactNumber': row[4],
+            'email': row[5],
+            'patientCode': row[6],
+            'address': row[7],
+            'createdAt': row[8],
+        }
+        for row in rows
+    ]
@@ -0,0 +1,288 @@
+"""Route each lab's patients and tests to its own SQLite file.
+
+The main database keeps labs, users and the shard map. Every shard is a
+complete, migrated medlab database, so any code that works on one
+connection works on any shard. When MEDLAB_SHARD_DIR is set, each new lab
+gets ``lab-<id>.db`` there; otherwise labs share the main database. Several
+labs can share a file with ``python shards.py assign``; their rows are told
+apart by ``lab_id``.
+
+Requests pick their shard from the id in the URL (ids encode their shard),
+then from ``?labId=``. Reads with neither run on every shard in parallel
+and are merged.
+"""
+import argparse
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, jsonify, request
+
+import db
+import metrics
+import migrations
+
+SHARD_DIR = os.environ.get('MEDLAB_SHARD_DIR')
+FANOUT_WORKERS = int(os.environ.get('MEDLAB_FANOUT_WORKERS', '8'))
+
+# Shard n allocates ids and change log seqs from n << ID_BITS, so ids are
+# unique across shards, a by-id route finds its shard without a lookup, and
+# ids stay below 2**53 for JavaScript clients.
+ID_BITS = 40
+MAIN_SHARD = 0
+
+# Tables that only the main database holds
+MAIN_TABLES = frozenset(('labs', 'users', 'shards', 'lab_shards'))
+
+
+class UnknownLab(LookupError):
+    pass
+
+
+class ShardRouter:
+    def __init__(self, main_path):
+        self.main_path = main_path
+        self._paths = {MAIN_SHARD: main_path}
+        self._labs = {}
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        paths = {MAIN_SHARD: self.main_path}
+        paths.update(conn.execute('SELECT id, path FROM shards').fetchall())
+        labs = dict(conn.execute('SELECT lab_id, shard_id FROM lab_shards').fetchall())
+        with self._lock:
+            self._paths = paths
+            self._labs = labs
+
+    @property
+    def sharded(self):
+        return len(self._paths) > 1
+
+    def shards(self):
+        """``(shard_id, path)`` for each database file, main first."""
+        seen = {}
+        for shard in sorted(self._paths):
+            seen.setdefault(self._paths[shard], shard)
+        return [(shard, path) for path, shard in seen.items()]
+
+    def paths(self):
+        return [path for _, path in self.shards()]
+
+    def path(self, shard_id):
+        path = self._paths.get(shard_id)
+        if path is None:
+            # Possibly created by another worker since we last looked
+            with db.get_pool(self.main_path).connection() as conn:
+                self.load(conn)
+            path = self._paths.get(shard_id)
+        return path
+
+    def path_for_id(self, row_id):
+        return self.path(int(row_id) >> ID_BITS)
+
+    def shard_for_lab(self, lab_id):
+        shard = self._labs.get(lab_id)
+        if shard is not None:
+            return shard
+        with db.get_pool(self.main_path).connection() as conn:
+            row = conn.execute('''
+                SELECT l.id, s.shard_id FROM labs l
+                LEFT JOIN lab_shards s ON s.lab_id = l.id
+                WHERE l.id = ?
+            ''', (lab_id,)).fetchone()
+        if row is None:
+            raise UnknownLab(f'Lab {lab_id} not found')
+        shard = row[1] if row[1] is not None else MAIN_SHARD
+        with self._lock:
+            self._labs[lab_id] = shard
+        return shard
+
+    def create_shard(self, conn, path):
+        """Register and initialise a shard file; the caller commits ``conn``."""
+        path = os.path.abspath(path)
+        row = conn.execute('SELECT id FROM shards WHERE path = ?', (path,)).fetchone()
+        if row:
+            return row[0]
+        shard_id = conn.execute('INSERT INTO shards (path) VALUES (?)', (path,)).lastrowid
+        initialize(path, shard_id)
+        with self._lock:
+            self._paths[shard_id] = path
+        return shard_id
+
+    def assign(self, conn, lab_id, shard_id):
+        """Map a lab to a shard; the caller commits ``conn``.
+
+        Existing rows are not moved, and other processes keep their cached
+        mapping until restarted, so assign labs before they have data.
+        """
+        conn.execute('INSERT OR REPLACE INTO lab_shards (lab_id, shard_id) VALUES (?, ?)', (lab_id, shard_id))
+        with self._lock:
+            self._labs[lab_id] = shard_id
+
+
+def initialize(path, shard_id=None):
+    """Bring a shard file up to the current schema."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = db.connect(path)
+    try:
+        migrations.migrate(conn)
+        if shard_id is not None:
+            # Move each sequence into the shard's range the first time round
+            start = shard_id << ID_BITS
+            for table in ('patients', 'tests', 'changes'):
+                row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+                if row is None:
+                    conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, start))
+                elif row[0] < start:
+                    conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (start, table))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def router():
+    return current_app.extensions['shards']
+
+
+def lab_id():
+    return g.get('lab_id')
+
+
+def route_by_id(row_id):
+    """Send the rest of this request to the shard that owns ``row_id``.
+
+    Must be called before the request's first get_db().
+    """
+    try:
+        path = router().path_for_id(row_id)
+    except (TypeError, ValueError):
+        return
+    if path:
+        g.database = path
+
+
+def _route_request():
+    shard_router = router()
+    view_args = request.view_args or {}
+    for name in ('patient_id', 'test_id'):
+        if name in view_args:
+            path = shard_router.path_for_id(view_args[name])
+            if path is None:
+                return jsonify({'error': 'Not found'}), 404
+            g.database = path
+            return None
+
+    requested_lab = request.args.get('labId', type=int)
+    if requested_lab is not None:
+        try:
+            shard = shard_router.shard_for_lab(requested_lab)
+        except UnknownLab as e:
+            return jsonify({'error': str(e)}), 404
+        g.lab_id = requested_lab
+        g.database = shard_router.path(shard)
+        return None
+
+    if request.method == 'GET' and shard_router.sharded:
+        # No lab given: an admin view over every lab
+        g.fan_out = shard_router.paths()
+    return None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='shard')
+    return _executor
+
+
+def fan_out_paths():
+    return g.get('fan_out')
+
+
+def map_paths(fn, paths):
+    """Run ``fn(conn)`` against each path in parallel; results in path order.
+
+    SQL run on the pool's threads is charged to the calling request's metrics.
+    """
+    def run(path):
+        with db.get_pool(path).connection() as conn:
+            return fn(conn)
+    if len(paths) == 1:
+        return [run(paths[0])]
+    stats = metrics.current_stats()
+    return list(_pool().map(lambda path: metrics.run_for(stats, run, path), paths))
+
+
+def query(fn):
+    """Run ``fn(conn)`` on the request's shard, or on every shard for fan-out reads.
+
+    Always returns a list of results, one per shard.
+    """
+    paths = fan_out_paths()
+    if not paths:
+        return [fn(db.get_db())]
+    return map_paths(fn, paths)
+
+
+def group_ids(ids):
+    """Group row ids by the path of the shard that owns them; unknown ids are dropped."""
+    shard_router = router()
+    groups = {}
+    for row_id in ids:
+        try:
+            path = shard_router.path_for_id(row_id)
+        except (TypeError, ValueError):
+            continue
+        if path:
+            groups.setdefault(path, []).append(row_id)
+    return groups
+
+
+def init_app(app):
+    app.extensions['shards'] = ShardRouter(app.config['DATABASE'])
+    app.before_request(_route_request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage lab shards.')
+    parser.add_argument('--db', default=db.DEFAULT_DATABASE, help='main database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    assign = commands.add_parser('assign', help='map a lab to a shard file, creating it if needed')
+    assign.add_argument('--lab', type=int, required=True)
+    assign.add_argument('--path', required=True, help='shard file; use the same path to group labs')
+    commands.add_parser('list', help='show shards and their labs')
+    args = parser.parse_args()
+
+    conn = db.connect(args.db)
+    try:
+        migrations.migrate(conn)
+        shard_router = ShardRouter(args.db)
+        shard_router.load(conn)
+        if args.command == 'assign':
+            if not conn.execute('SELECT 1 FROM labs WHERE id = ?', (args.lab,)).fetchone():
+                print(f'Lab {args.lab} not found', file=sys.stderr)
+                return 1
+            shard_id = shard_router.create_shard(conn, args.path)
+            shard_router.assign(conn, args.lab, shard_id)
+            conn.commit()
+            print(f'lab {args.lab} -> shard {shard_id} ({os.path.abspath(args.path)})')
+        else:
+            print(f'0\t{os.path.abspath(args.db)}\t(main; labs without a shard)')
+            for shard_id, path in conn.execute('SELECT id, path FROM shards ORDER BY id'):
+                labs = [str(lab) for (lab,) in conn.execute(
+                    'SELECT lab_id FROM lab_shards WHERE shard_id = ? ORDER BY lab_id', (shard_id,)
+                )]
+                print(f'{shard_id}\t{path}\tlabs {", ".join(labs) or "-"}')
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
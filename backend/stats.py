@@ -0,0 +1,258 @@
+from datetime import datetime, timedelta
+
+from ranges import ABNORMAL_STATUSES
+
+# Rollup tables kept current by triggers on patients/tests, so dashboard
+# numbers are point lookups instead of scans over both tables.
+
+AGE_GROUPS = (
+    ('0-17 years', 0, 17),
+    ('18-35 years', 18, 35),
+    ('36-50 years', 36, 50),
+    ('51-65 years', 51, 65),
+    ('66+ years', 66, None),
+)
+
+COUNTERS = ('patients', 'tests', 'patients_with_tests', 'abnormal_tests')
+
+
+def _age_group_sql(column):
+    cases = []
+    for label, low, high in AGE_GROUPS:
+        if high is None:
+            cases.append(f"WHEN {column} >= {low} THEN '{label}'")
+        else:
+            cases.append(f"WHEN {column} BETWEEN {low} AND {high} THEN '{label}'")
+    return 'CASE ' + ' '.join(cases) + " ELSE 'Unknown' END"
+
+
+def _is_abnormal_sql(column):
+    statuses = ', '.join(f"'{status}'" for status in ABNORMAL_STATUSES)
+    return f'COALESCE({column} IN ({statuses}), 0)'
+
+
+def _schema():
+    new_group = _age_group_sql('NEW.age')
+    old_group = _age_group_sql('OLD.age')
+    new_abnormal = _is_abnormal_sql('NEW.status')
+    old_abnormal = _is_abnormal_sql('OLD.status')
+    return (
+        '''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS patient_test_counts (
+                patient_id INTEGER PRIMARY KEY,
+                tests INTEGER NOT NULL
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS daily_test_counts (
+                day TEXT PRIMARY KEY,
+                tests INTEGER NOT NULL
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS patient_demographics (
+                gender TEXT NOT NULL,
+                age_group TEXT NOT NULL,
+                patients INTEGER NOT NULL,
+                PRIMARY KEY (gender, age_group)
+            )
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS stats_patient_insert AFTER INSERT ON patients
+            BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'patients';
+                INSERT INTO patient_demographics (gender, age_group, patients)
+                VALUES (NEW.gender, {new_group}, 1)
+                ON CONFLICT (gender, age_group) DO UPDATE SET patients = patients + 1;
+            END
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS stats_patient_delete AFTER DELETE ON patients
+            BEGIN
+                UPDATE stats_counters SET value = value - 1 WHERE name = 'patients';
+                UPDATE patient_demographics SET patients = patients - 1
+                WHERE gender = OLD.gender AND age_group = {old_group};
+            END
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS stats_patient_update AFTER UPDATE OF age, gender ON patients
+            BEGIN
+                UPDATE patient_demographics SET patients = patients - 1
+                WHERE gender = OLD.gender AND age_group = {old_group};
+                INSERT INTO patient_demographics (gender, age_group, patients)
+                VALUES (NEW.gender, {new_group}, 1)
+                ON CONFLICT (gender, age_group) DO UPDATE SET patients = patients + 1;
+            END
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS stats_test_insert AFTER INSERT ON tests
+            BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'tests';
+                UPDATE stats_counters SET value = value + {new_abnormal} WHERE name = 'abnormal_tests';
+                INSERT INTO patient_test_counts (patient_id, tests) VALUES (NEW.patient_id, 1)
+                ON CONFLICT (patient_id) DO UPDATE SET tests = tests + 1;
+                UPDATE stats_counters SET value = value + 1
+                WHERE name = 'patients_with_tests'
+                  AND (SELECT tests FROM patient_test_counts WHERE patient_id = NEW.patient_id) = 1;
+                INSERT INTO daily_test_counts (day, tests) VALUES (date(NEW.created_at), 1)
+                ON CONFLICT (day) DO UPDATE SET tests = tests + 1;
+            END
+        ''',
+        f'''
+            -- Archived tests still count, so the archiver's deletes are skipped
+            CREATE TRIGGER IF NOT EXISTS stats_test_delete AFTER DELETE ON tests
+            WHEN (SELECT value FROM archive_state WHERE name = 'moving') IS NOT 1
+            BEGIN
+                UPDATE stats_counters SET value = value - 1 WHERE name = 'tests';
+                UPDATE stats_counters SET value = value - {old_abnormal} WHERE name = 'abnormal_tests';
+                UPDATE patient_test_counts SET tests = tests - 1 WHERE patient_id = OLD.patient_id;
+                UPDATE stats_counters SET value = value - 1
+                WHERE name = 'patients_with_tests'
+                  AND (SELECT tests FROM patient_test_counts WHERE patient_id = OLD.patient_id) = 0;
+                DELETE FROM patient_test_counts WHERE patient_id = OLD.patient_id AND tests <= 0;
+                UPDATE daily_test_counts SET tests = tests - 1 WHERE day = date(OLD.created_at);
+            END
+        ''',
+        f'''
+            CREATE TRIGGER IF NOT EXISTS stats_test_status AFTER UPDATE OF status ON tests
+            BEGIN
+                UPDATE stats_counters SET value = value + {new_abnormal} - {old_abnormal}
+                WHERE name = 'abnormal_tests';
+            END
+        ''',
+    )
+
+
+def create(conn):
+    """Create the rollup tables and triggers and fill them from the base tables.
+
+    Runs inside a migration's transaction, so no write can land between
+    dropping the old triggers and creating the new ones.
+    """
+    triggers = conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'stats_%'").fetchall()
+    for (name,) in triggers:
+        conn.execute(f'DROP TRIGGER {name}')
+    for statement in _schema():
+        conn.execute(statement)
+    rebuild(conn)
+
+
+def rebuild(conn):
+    """Recompute every rollup from the base tables (full scan); the caller commits."""
+    db_cursor = conn.cursor()
+    db_cursor.execute('DELETE FROM stats_counters')
+    db_cursor.execute('DELETE FROM patient_test_counts')
+    db_cursor.execute('DELETE FROM daily_test_counts')
+    db_cursor.execute('DELETE FROM patient_demographics')
+
+    # Archived tests are counted from the archive manifest. Daily counts
+    # cover live tests only; they feed "today" and "this week", which are
+    # never old enough to be archived.
+    db_cursor.execute('''
+        INSERT INTO patient_test_counts (patient_id, tests)
+        SELECT patient_id, SUM(tests) FROM (
+            SELECT patient_id, COUNT(*) AS tests FROM tests GROUP BY patient_id
+            UNION ALL
+            SELECT patient_id, tests FROM archive_manifest
+        )
+        GROUP BY patient_id
+    ''')
+    db_cursor.execute('''
+        INSERT INTO daily_test_counts (day, tests)
+        SELECT date(created_at), COUNT(*) FROM tests GROUP BY date(created_at)
+    ''')
+    db_cursor.execute(f'''
+        INSERT INTO patient_demographics (gender, age_group, patients)
+        SELECT gender, {_age_group_sql('age')} AS age_group, COUNT(*)
+        FROM patients GROUP BY gender, age_group
+    ''')
+    db_cursor.executemany('INSERT INTO stats_counters (name, value) VALUES (?, 0)', [(name,) for name in COUNTERS])
+    db_cursor.execute("UPDATE stats_counters SET value = (SELECT COUNT(*) FROM patients) WHERE name = 'patients'")
+    db_cursor.execute('''
+        UPDATE stats_counters
+        SET value = (SELECT COUNT(*) FROM tests) + (SELECT COALESCE(SUM(tests), 0) FROM archive_manifest)
+        WHERE name = 'tests'
+    ''')
+    db_cursor.execute(f'''
+        UPDATE stats_counters
+        SET value = (SELECT COUNT(*) FROM tests WHERE {_is_abnormal_sql('status')})
+                  + (SELECT COALESCE(SUM(abnormal), 0) FROM archive_manifest)
+        WHERE name = 'abnormal_tests'
+    ''')
+    db_cursor.execute('''
+        UPDATE stats_counters SET value = (SELECT COUNT(*) FROM patient_test_counts)
+        WHERE name = 'patients_with_tests'
+    ''')
+
+
+COUNTERS_SQL = 'SELECT name, value FROM stats_counters'
+TESTS_SINCE_SQL = 'SELECT COALESCE(SUM(tests), 0) FROM daily_test_counts WHERE day >= ?'
+DEMOGRAPHICS_SQL = 'SELECT gender, age_group, patients FROM patient_demographics'
+
+
+def _counters(conn):
+    return dict(conn.execute(COUNTERS_SQL).fetchall())
+
+
+def _tests_since(conn, day):
+    return conn.execute(TESTS_SINCE_SQL, (day,)).fetchone()[0]
+
+
+def summary(conn, today=None):
+    today = today or datetime.utcnow().date()
+    counters = _counters(conn)
+    return {
+        'totalPatients': counters.get('patients', 0),
+        'totalTests': counters.get('tests', 0),
+        'reportsGenerated': counters.get('patients_with_tests', 0),
+        'abnormalResults': counters.get('abnormal_tests', 0),
+        'testsToday': _tests_since(conn, today.isoformat()),
+    }
+
+
+def analytics(conn, today=None):
+    today = today or datetime.utcnow().date()
+    result = summary(conn, today)
+    result['testsThisWeek'] = _tests_since(conn, (today - timedelta(days=6)).isoformat())
+
+    genders = {'Male': 0, 'Female': 0, 'Other': 0}
+    ages = {label: 0 for label, _, _ in AGE_GROUPS}
+    for gender, age_group, patients in conn.execute(DEMOGRAPHICS_SQL):
+        gender = (gender or '').capitalize()
+        genders[gender if gender in ('Male', 'Female') else 'Other'] += patients
+        if age_group in ages:
+            ages[age_group] += patients
+
+    result['genderDistribution'] = genders
+    result['ageDistribution'] = [{'label': label, 'count': count} for label, count in ages.items()]
+    return result
+
+
+def combine(results):
+    """Merge summary or analytics results from several shards."""
+    if len(results) == 1:
+        return results[0]
+    combined = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, dict):
+                totals = combined.setdefault(key, {})
+                for name, count in value.items():
+                    totals[name] = totals.get(name, 0) + count
+            elif isinstance(value, list):
+                totals = combined.setdefault(key, {})
+                for item in value:
+                    totals[item['label']] = totals.get(item['label'], 0) + item['count']
+            else:
+                combined[key] = combined.get(key, 0) + value
+    if 'ageDistribution' in combined:
+        combined['ageDistribution'] = [
+            {'label': label, 'count': count} for label, count in combined['ageDistribution'].items()
+        ]
+    return combined
@@ -0,0 +1,231 @@
+from datetime import datetime
+
+import archive
+import ranges
+
+# Largest plausible change between consecutive results, as a percentage of
+# the earlier value. A bigger jump is flagged for review: it is more often
+# a mislabelled sample or an analyser fault than a real change.
+DEFAULT_DELTA_PERCENT = 50.0
+DELTA_PERCENT = {
+    'HbA1c': 20.0,
+    'Hemoglobin (Hb)': 20.0,
+    'Packed Cell Volume (PCV)': 20.0,
+    'Red Blood Cell Count (RBC)': 20.0,
+    'Mean Corpuscular Volume (MCV)': 10.0,
+    'Mean Corpuscular Hemoglobin Concentration (MCHC)': 10.0,
+    'Sodium': 5.0,
+    'Chloride': 10.0,
+    'Potassium': 20.0,
+    'Calcium (Total)': 15.0,
+    'Albumin': 20.0,
+    'Total Protein': 20.0,
+}
+
+MIN_POINTS = 3
+
+SUMMARY_SQL = '''
+    SELECT test_name, COUNT(*), MIN(created_at), MAX(created_at)
+    FROM tests
+    WHERE patient_id = ?
+    GROUP BY test_name
+'''
+
+HISTORY_COLUMNS = ('id', 'test_value', 'unit', 'normal_range', 'status', 'created_at')
+
+# The window runs over the patient's whole history for the test, so the
+# first point inside a date range still gets its real predecessor.
+HISTORY_SQL = '''
+    SELECT * FROM (
+        SELECT id, test_value, unit, normal_range, status, created_at,
+               LAG(test_value) OVER w, LAG(status) OVER w, LAG(created_at) OVER w
+        FROM tests
+        WHERE patient_id = ? AND test_name = ?
+        WINDOW w AS (ORDER BY created_at, id)
+    )
+    WHERE created_at >= ? AND created_at <= ?
+'''
+
+
+class TrendQueryError(ValueError):
+    pass
+
+
+def delta_check(test_name, value, status, previous_value, previous_status, previous_at):
+    """Compare a result with the patient's previous result for the same test.
+
+    Numeric results are flagged when they moved by more than the test's
+    delta limit; anything else is flagged when its status changed.
+    """
+    if previous_at is None:
+        return None
+    check = {
+        'previousValue': previous_value,
+        'previousAt': previous_at,
+        'delta': None,
+        'percentChange': None,
+    }
+    current, previous = ranges.to_number(value), ranges.to_number(previous_value)
+    if current is not None and previous is not None:
+        check['delta'] = round(current - previous, 4)
+        if previous:
+            percent = (current - previous) / abs(previous) * 100
+            check['percentChange'] = round(percent, 1)
+            check['flagged'] = abs(percent) > DELTA_PERCENT.get(test_name, DEFAULT_DELTA_PERCENT)
+        else:
+            check['flagged'] = current != previous
+    else:
+        check['flagged'] = status != previous_status
+    return check
+
+
+def annotate_deltas(tests):
+    """Add a ``deltaCheck`` to each report test, given tests newest first.
+
+    The report already holds the patient's full history, so a single pass
+    from the oldest result is enough to find every predecessor.
+    """
+    latest = {}
+    for test in reversed(tests):
+        previous = latest.get(test['testName'])
+        if previous is None:
+            test['deltaCheck'] = None
+        else:
+            test['deltaCheck'] = delta_check(
+                test['testName'], test['testValue'], test['status'],
+                previous['testValue'], previous['status'], previous['createdAt'],
+            )
+        latest[test['testName']] = test
+    return tests
+
+
+def _timestamp(value):
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def downsample(points, target):
+    """Reduce points to ``target`` with largest-triangle-three-buckets.
+
+    LTTB keeps the first and last points and, from each bucket in between,
+    the point that best preserves the visual shape of the series, so peaks
+    and dips survive. Series with non-numeric values are thinned evenly instead.
+    """
+    if len(points) <= target:
+        return points
+    xs = [_timestamp(p['createdAt']) for p in points]
+    ys = [ranges.to_number(p['value']) for p in points]
+    if any(y is None for y in ys):
+        step = (len(points) - 1) / (target - 1)
+        return [points[round(i * step)] for i in range(target)]
+
+    kept = [0]
+    bucket_size = (len(points) - 2) / (target - 2)
+    for bucket in range(target - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, len(points))
+        # The average of the next bucket stands in for the next chosen point
+        next_range = range(end, next_end) if end < next_end else range(len(points) - 1, len(points))
+        avg_x = sum(xs[i] for i in next_range) / len(next_range)
+        avg_y = sum(ys[i] for i in next_range) / len(next_range)
+        ax, ay = xs[kept[-1]], ys[kept[-1]]
+        best, best_area = start, -1.0
+        for i in range(start, end):
+            area = abs((ax - avg_x) * (ys[i] - ay) - (ax - xs[i]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = i, area
+        kept.append(best)
+    kept.append(len(points) - 1)
+    return [points[i] for i in kept]
+
+
+def _bound(value, default_time):
+    # created_at has NUMERIC affinity, so a bound like '2024' would be
+    # compared as a number; always pass a full timestamp
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise TrendQueryError(f'Invalid date: {value}')
+    if len(value) == len('YYYY-MM-DD'):
+        return f'{value} {default_time}'
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def summary(conn, patient_id):
+    totals = {}
+    sources = [conn.execute(SUMMARY_SQL, (patient_id,)).fetchall()]
+    sources.extend(
+        archive_conn.execute(SUMMARY_SQL, (patient_id,)).fetchall()
+        for archive_conn in archive.each_archive(conn, patient_id)
+    )
+    for rows in sources:
+        for name, count, first_at, last_at in rows:
+            if name in totals:
+                total = totals[name]
+                total['count'] += count
+                total['firstAt'] = min(total['firstAt'], first_at)
+                total['lastAt'] = max(total['lastAt'], last_at)
+            else:
+                totals[name] = {'testName': name, 'count': count, 'firstAt': first_at, 'lastAt': last_at}
+    return sorted(totals.values(), key=lambda total: total['testName'])
+
+
+def _with_archived(conn, patient_id, test_name, rows, start, end):
+    # Archived results are older than every live one, so only the first
+    # live result's predecessor comes from the archive
+    archived = archive.archived_tests(conn, patient_id, HISTORY_COLUMNS, test_name, dated=True)
+    if not archived:
+        return rows
+    live = {row[0] for row in rows}
+    chained = []
+    previous = None
+    for row in reversed(archived):
+        if row[0] in live:
+            continue
+        lagged = (previous[1], previous[4], previous[5]) if previous else (None, None, None)
+        if start <= row[5] <= end:
+            chained.append(row + lagged)
+        previous = row
+    if previous:
+        lagged = (previous[1], previous[4], previous[5])
+        rows = [row[:6] + lagged if row[8] is None else row for row in rows]
+    return chained + rows
+
+
+def history(conn, patient_id, test_name, start=None, end=None, points=None):
+    """Return one test's results for a patient, oldest first, with deltas.
+
+    Served from idx_tests_patient_name_created, so the cost depends on this
+    patient's history for this test, not on the size of the tests table.
+    Archives are read only when the patient has archived results.
+    """
+    if points is not None and points < MIN_POINTS:
+        raise TrendQueryError(f'points must be at least {MIN_POINTS}')
+    start = _bound(start, '00:00:00') if start else ''
+    end = _bound(end, '23:59:59') if end else '9999-12-31 23:59:59'
+    rows = conn.execute(HISTORY_SQL, (patient_id, test_name, start, end)).fetchall()
+    # Already in window order in practice; an outer ORDER BY would add a
+    # temp sort, and re-sorting sorted rows here is linear
+    rows.sort(key=lambda row: (row[5] or '', row[0]))
+    rows = _with_archived(conn, patient_id, test_name, rows, start, end)
+    series = []
+    for test_id, value, unit, normal_range, status, created_at, prev_value, prev_status, prev_at in rows:
+        series.append({
+            'id': test_id,
+            'value': value,
+            'unit': unit,
+            'normalRange': normal_range,
+            'status': status,
+            'createdAt': created_at,
+            'deltaCheck': delta_check(test_name, value, status, prev_value, prev_status, prev_at),
+        })
+    sampled = downsample(series, points) if points else series
+    return {
+        'testName': test_name,
+        'count': len(series),
+        'downsampled': len(sampled) < len(series),
+        'points': sampled,
+    }
@@ -1,4 +1,5 @@
 import React, { useState, useEffect } from 'react';
+import { useChanges } from '../useChanges';
 
 const ageGroups = [
   { label: '0-17 years', min: 0, max: 17 },
@@ -12,62 +13,47 @@ const Analytics = () => {
   const [summary, setSummary] = useState({
     totalPatients: 0,
     totalTests: 0,
+    testsToday: 0,
+    testsThisWeek: 0,
     abnormalResults: 0,
     reportsGenerated: 0,
   });
-  const [patients, setPatients] = useState([]);
-  const [tests, setTests] = useState([]);
+  const [genderCounts, setGenderCounts] = useState({ Male: 0, Female: 0, Other: 0 });
+  const [ageCounts, setAgeCounts] = useState(ageGroups.map(() => 0));
   const [loading, setLoading] = useState(true);
   const [activeTab, setActiveTab] = useState('Demographics');
 
+  // loading starts true; later refreshes keep the current figures on screen
+  const fetchData = async () => {
+    try {
+      const res = await fetch('http://localhost:5000/api/stats/analytics');
+      if (res.ok) {
+        const data = await res.json();
+        setSummary({
+          totalPatients: data.totalPatients,
+          totalTests: data.totalTests,
+          testsToday: data.testsToday,
+          testsThisWeek: data.testsThisWeek,
+          abnormalResults: data.abnormalResults || 0,
+          reportsGenerated: data.reportsGenerated,
+        });
+        setGenderCounts(data.genderDistribution);
+        setAgeCounts(ageGroups.map(g => {
+          const bucket = data.ageDistribution.find(a => a.label === g.label);
+          return bucket ? bucket.count : 0;
+        }));
+      }
+    } catch (e) {}
+    setLoading(false);
+  };
+
   useEffect(() => {
-    const fetchData = async () => {
-      setLoading(true);
-      let patientsData = [];
-      let testsData = [];
-      try {
-        const res = await fetch('http://localhost:5000/api/patients');
-        if (res.ok) patientsData = await res.json();
-      } catch (e) {}
-      try {
-        const res = await fetch('http://localhost:5000/api/tests');
-        if (res.ok) testsData = await res.json();
-      } catch (e) {}
-      // Calculate abnormal results (example: status === 'High' or 'Low')
-      const abnormalResults = testsData.filter(t => t.status === 'High' || t.status === 'Low').length;
-      setSummary({
-        totalPatients: patientsData.length,
-        totalTests: testsData.length || 0,
-        abnormalResults,
-        reportsGenerated: 0, 
-      });
-      setPatients(patientsData);
-      setTests(testsData);
-      setLoading(false);
-    };
     fetchData();
   }, []);
 
-  // Gender Distribution
-  const genderCounts = {
-    Male: 0,
-    Female: 0,
-    Other: 0,
-  };
-  patients.forEach(p => {
-    if (p.gender === 'Male') genderCounts.Male++;
-    else if (p.gender === 'Female') genderCounts.Female++;
-    else genderCounts.Other++;
-  });
-  const totalGender = genderCounts.Male + genderCounts.Female + genderCounts.Other;
+  useChanges(fetchData, fetchData);
 
-  // Age Distribution
-  const ageCounts = ageGroups.map(g => 0);
-  patients.forEach(p => {
-    const age = parseInt(p.age, 10);
-    const idx = ageGroups.findIndex(g => age >= g.min && age <= g.max);
-    if (idx !== -1) ageCounts[idx]++;
-  });
+  const totalGender = genderCounts.Male + genderCounts.Female + genderCounts.Other;
   const totalAges = ageCounts.reduce((a, b) => a + b, 0);
 
   const summaryCards = [
@@ -80,7 +66,7 @@ const Analytics = () => {
     {
       title: 'Tests Conducted',
       value: summary.totalTests,
-      subtitle: `${summary.totalTests} today, ${summary.totalTests} this week`,
+      subtitle: `${summary.testsToday} today, ${summary.testsThisWeek} this week`,
       icon: <span className="material-icons text-green-500">science</span>,
     },
     {
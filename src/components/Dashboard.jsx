@@ -1,4 +1,5 @@
 import React, { useState, useEffect } from 'react';
+import { useChanges } from '../useChanges';
 
 const quickActions = [
   {
@@ -42,31 +43,12 @@ const Dashboard = () => {
 
     const fetchDashboardStats = async () => {
         try {
-            // Fetch total patients
-            const patientsResponse = await fetch('http://localhost:5000/api/patients');
-            if (!patientsResponse.ok) {
-                throw new Error('Failed to fetch patients data');
+            // Aggregates are maintained server-side
+            const response = await fetch('http://localhost:5000/api/stats');
+            if (!response.ok) {
+                throw new Error('Failed to fetch dashboard stats');
             }
-            const patientsData = await patientsResponse.json();
-
-            // Fetch total tests
-            const testsResponse = await fetch('http://localhost:5000/api/tests');
-            if (!testsResponse.ok) {
-                throw new Error('Failed to fetch tests data');
-            }
-            const testsData = await testsResponse.json();
-
-            // Calculate stats
-            const totalPatients = patientsData.length;
-            const totalTests = testsData.length;
-            // Reports generated = unique patient IDs in tests
-            const reportsGenerated = new Set(testsData.map(t => t.patientId)).size;
-            // Tests today 
-            const today = new Date().toISOString().slice(0, 10);
-            const testsToday = testsData.filter(test => {
-                const testDate = new Date(test.createdAt).toISOString().slice(0, 10);
-                return testDate === today;
-            }).length;
+            const { totalPatients, totalTests, reportsGenerated, testsToday } = await response.json();
 
             setStats({
                 totalPatients,
@@ -81,6 +63,9 @@ const Dashboard = () => {
         }
     };
 
+    // Counters are cheap to refetch; the change feed says when
+    useChanges(fetchDashboardStats, fetchDashboardStats);
+
     const statsCards = [
         {
             title: 'Total Patients',
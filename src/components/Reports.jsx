@@ -313,6 +313,8 @@ const Reports = () => {
 
     // Helper: status logic
     const getStatus = (test) => {
+        // Status is evaluated and stored by the backend when the test is added
+        if (test.status) return test.status;
         const value = test.testValue;
         const ref = String(test.normalRange || '').trim();
         // Handle Positive/Negative
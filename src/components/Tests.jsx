@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import testsData from '../data/testsData';
+import { applyChanges, useChanges } from '../useChanges';
 
 const Tests = () => {
     const [formData, setFormData] = useState({
@@ -29,12 +30,17 @@ const Tests = () => {
     useEffect(() => {
         fetchPatients();
         fetchTests();
-
-        // Set up polling for tests every 30 seconds
-        const intervalId = setInterval(fetchTests, 30000);
-        return () => clearInterval(intervalId);
     }, []);
 
+    // Then keep both lists current from the change feed
+    useChanges((changes) => {
+        setPatients(current => applyChanges(current, changes, 'patients'));
+        setTests(current => applyChanges(current, changes, 'tests'));
+    }, () => {
+        fetchPatients();
+        fetchTests();
+    });
+
     const fetchPatients = async () => {
         try {
             const response = await fetch('http://localhost:5000/api/patients');
@@ -158,6 +158,8 @@ const ViewReport = () => {
     const reportTime = now.toLocaleTimeString();
 
     const getStatus = (test) => {
+        // Status is evaluated and stored by the backend when the test is added
+        if (test.status) return test.status;
         const value = test.testValue;
         const ref = String(test.normalRange || '').trim();
         if (/negative|positive/i.test(ref)) {
@@ -0,0 +1,135 @@
+import { useEffect, useRef } from 'react';
+
+const CHANGES_URL = 'http://localhost:5000/api/changes';
+// Streams have their own server so an open one does not hold an API thread
+const STREAM_URL = 'http://localhost:5001/api/changes';
+
+// Changes arriving within this window are handed over together, so a batch
+// import updates the page once instead of once per row
+const BATCH_MS = 250;
+
+// While the server is at its stream limit, fetch pages of changes this
+// often and try streaming again after each one
+const POLL_MS = 5000;
+
+// Follows the server's change feed. EventSource reconnects by itself and
+// resumes from the last event id; onReset runs when the server no longer
+// has our place in the log and the caller must reload. When the stream
+// server refuses (503 at its stream limit) the hook polls the API instead.
+export function useChanges(onChanges, onReset) {
+  const handlers = useRef({ onChanges, onReset });
+  handlers.current = { onChanges, onReset };
+
+  useEffect(() => {
+    let source = null;
+    let cursor = null;
+    let pending = [];
+    let timer = null;
+    let pollTimer = null;
+    let stopped = false;
+
+    const flush = () => {
+      timer = null;
+      const changes = pending;
+      pending = [];
+      handlers.current.onChanges(changes);
+    };
+
+    const deliver = (change) => {
+      pending.push(change);
+      if (!timer) {
+        timer = setTimeout(flush, BATCH_MS);
+      }
+    };
+
+    const reset = () => {
+      cursor = null;
+      pending = [];
+      if (handlers.current.onReset) {
+        handlers.current.onReset();
+      }
+    };
+
+    const withCursor = (url) => (cursor ? `${url}?since=${encodeURIComponent(cursor)}` : url);
+
+    const poll = async () => {
+      pollTimer = null;
+      try {
+        const response = await fetch(withCursor(CHANGES_URL));
+        const page = response.ok ? await response.json() : null;
+        if (stopped) {
+          return;
+        }
+        if (response.status === 410) {
+          reset();
+        } else if (page) {
+          page.changes.forEach(deliver);
+          cursor = page.cursor;
+        }
+      } catch {
+        // Network trouble; the next attempt tries again
+      }
+      if (!stopped) {
+        connect();
+      }
+    };
+
+    const fallBack = () => {
+      source.close();
+      if (!pollTimer) {
+        pollTimer = setTimeout(poll, POLL_MS);
+      }
+    };
+
+    const connect = () => {
+      source = new EventSource(withCursor(STREAM_URL));
+      source.addEventListener('ready', (event) => {
+        cursor = event.lastEventId;
+      });
+      source.onmessage = (event) => {
+        cursor = event.lastEventId;
+        deliver(JSON.parse(event.data));
+      };
+      source.addEventListener('reset', () => {
+        // Start over without the stale Last-Event-ID
+        source.close();
+        reset();
+        connect();
+      });
+      source.addEventListener('busy', fallBack);
+      source.onerror = () => {
+        // CONNECTING means EventSource is already retrying; CLOSED means
+        // the server refused the stream
+        if (source.readyState === EventSource.CLOSED) {
+          fallBack();
+        }
+      };
+    };
+
+    connect();
+    return () => {
+      stopped = true;
+      clearTimeout(timer);
+      clearTimeout(pollTimer);
+      source.close();
+    };
+  }, []);
+}
+
+// Apply changes for one table to rows shaped like its list endpoint
+export function applyChanges(rows, changes, table) {
+  let result = rows;
+  for (const change of changes) {
+    if (change.table !== table) {
+      continue;
+    }
+    if (!change.data) {
+      result = result.filter(row => row.id !== change.id);
+    } else if (result.some(row => row.id === change.id)) {
+      result = result.map(row => (row.id === change.id ? change.data : row));
+    } else {
+      result = [change.data, ...result];
+    }
+  }
+  return result;
+}